@@ -0,0 +1,94 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц одного списка запрашивается из CRM одновременно
+PAGINATOR_CONCURRENCY = int(os.getenv("CRM_PAGINATOR_CONCURRENCY", 4))
+
+
+class CrmPageError(Exception):
+    """
+    Страницу списка не удалось получить из CRM: обход прерван и данные неполные.
+    """
+
+    def __init__(self, page: int):
+        super().__init__(f"Не удалось получить страницу {page} из CRM")
+        self.page = page
+
+
+def get_last_page(total: int, count: int) -> int:
+    """
+    Номер последней страницы (с нуля) по общему числу записей и размеру страницы.
+    """
+    if not count or not total:
+        return 0
+    return max(ceil(total / count) - 1, 0)
+
+
+def iter_pages(
+    fetch_page: Callable[[int], dict | None],
+    concurrency: int = PAGINATOR_CONCURRENCY,
+    stop_when: Callable[[dict], bool] | None = None,
+    max_pages: int | None = None,
+) -> Iterator[dict]:
+    """
+    Обходит постраничный список CRM (ответы вида {"total", "count", "items"}).
+
+    Страница 0 запрашивается первой, по ней определяется количество страниц,
+    остальные запрашиваются конкурентно (не более concurrency одновременно).
+    Записи отдаются строго в порядке страниц.
+
+    stop_when - предикат для раннего выхода: запись, на которой он сработал,
+    отдается последней, оставшиеся запросы отменяются.
+    max_pages - ограничение на количество обходимых страниц.
+
+    Если какую-то страницу получить не удалось, бросает CrmPageError.
+    """
+    first = fetch_page(0)
+    if not first:
+        raise CrmPageError(0)
+
+    items = first.get("items", [])
+    for item in items:
+        yield item
+        if stop_when and stop_when(item):
+            return
+
+    last_page = get_last_page(first.get("total", 0), len(items) or first.get("count", 0))
+    if max_pages is not None:
+        last_page = min(last_page, max_pages - 1)
+    if last_page == 0:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending: deque = deque()
+    next_page = 1
+    try:
+        while next_page <= last_page and len(pending) < concurrency:
+            pending.append((next_page, executor.submit(fetch_page, next_page)))
+            next_page += 1
+
+        while pending:
+            page, future = pending.popleft()
+            response = future.result()
+            if not response:
+                raise CrmPageError(page)
+
+            # Освободившийся слот сразу занимаем следующей страницей
+            if next_page <= last_page:
+                pending.append((next_page, executor.submit(fetch_page, next_page)))
+                next_page += 1
+
+            for item in response.get("items", []):
+                yield item
+                if stop_when and stop_when(item):
+                    return
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
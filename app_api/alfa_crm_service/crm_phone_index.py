@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import uuid
+
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Индекс телефонов: хэш Redis {телефон в E.164: {"entries": [{"branch_id", "crm_id"}, ...], "branches": [...]}}
+# branches - филиалы, клиенты которых полностью просмотрены для этого телефона:
+# по записи можно утверждать, что других клиентов с этим телефоном в этих филиалах нет
+PHONE_INDEX_KEY = "crm:phone_index"
+# В индексе только ID: карточки клиентов берутся из CRM (customer/index кэшируется на RESPONSE_CACHE_TTLS),
+# чтобы поиск не отдавал данные возрастом до PHONE_INDEX_TTL
+# Индекс пересобирается периодической задачей; если она перестала выполняться, индекс истекает
+PHONE_INDEX_TTL = int(os.getenv("CRM_PHONE_INDEX_TTL", 2 * 24 * 60 * 60))
+PHONE_INDEX_ENABLED = os.getenv("CRM_PHONE_INDEX_ENABLED", "True") == "True"
+PHONE_INDEX_WRITE_BATCH_SIZE = 1000
+
+# Нормализация номеров без кода страны (по умолчанию - Беларусь: 80XX XXX-XX-XX -> +375XX XXX-XX-XX)
+PHONE_DEFAULT_COUNTRY_CODE = os.getenv("PHONE_DEFAULT_COUNTRY_CODE", "375")
+PHONE_NATIONAL_PREFIX = os.getenv("PHONE_NATIONAL_PREFIX", "80")
+PHONE_NATIONAL_NUMBER_LENGTH = int(os.getenv("PHONE_NATIONAL_NUMBER_LENGTH", 9))
+
+
+def normalize_phone(phone) -> str | None:
+    """
+    Приводит номер телефона к формату E.164 (+375291234567).
+    Возвращает None, если номер не похож на телефонный.
+    """
+    digits = "".join(ch for ch in str(phone or "") if ch.isdigit())
+    if len(digits) == PHONE_NATIONAL_NUMBER_LENGTH:
+        digits = PHONE_DEFAULT_COUNTRY_CODE + digits
+    elif digits.startswith(PHONE_NATIONAL_PREFIX) and len(digits) == len(PHONE_NATIONAL_PREFIX) + PHONE_NATIONAL_NUMBER_LENGTH:
+        digits = PHONE_DEFAULT_COUNTRY_CODE + digits[len(PHONE_NATIONAL_PREFIX):]
+    if not 8 <= len(digits) <= 15:
+        return None
+    return f"+{digits}"
+
+
+def get_customer_phones(customer: dict) -> set:
+    """
+    Нормализованные телефоны клиента CRM (в CRM поле phone - список строк).
+    """
+    phones = customer.get("phone") or []
+    if isinstance(phones, str):
+        phones = [phones]
+    return {phone for phone in map(normalize_phone, phones) if phone}
+
+
+def get_customer_key(branch_id, crm_id) -> str:
+    return f"{branch_id}:{crm_id}"
+
+
+def make_entry(branch_id, crm_id) -> dict:
+    return {"branch_id": str(branch_id), "crm_id": str(crm_id)}
+
+
+class PhoneIndexBuilder:
+    """
+    Собирает новый индекс телефонов из полного обхода клиентов филиалов и из БД.
+    """
+
+    def __init__(self):
+        self.entries: dict = {}  # телефон -> {customer_key: entry}
+        self.branches: set = set()  # филиалы, обойденные полностью
+
+    def add(self, phone, branch_id, crm_id):
+        phone = normalize_phone(phone)
+        if not phone or not crm_id:
+            return
+        self.entries.setdefault(phone, {})[get_customer_key(branch_id, crm_id)] = make_entry(branch_id, crm_id)
+
+    def add_customers(self, branch_id, customers):
+        """
+        Добавляет клиентов полностью обойденного филиала.
+        """
+        self.branches.add(str(branch_id))
+        for customer in customers:
+            for phone in get_customer_phones(customer):
+                self.add(phone, branch_id, customer.get("id"))
+
+
+class PhoneIndex:
+    """
+    Локальный индекс телефонов клиентов CRM в Redis: телефон -> (филиал, crm_id).
+    Поиск по индексу заменяет перебор customer/index по всем филиалам и статусам.
+    Ошибки Redis не прерывают работу: индекс считается пустым, поиск идет в CRM.
+    """
+
+    def __init__(self, key: str = PHONE_INDEX_KEY, ttl: int = PHONE_INDEX_TTL, enabled: bool = PHONE_INDEX_ENABLED):
+        self.key = key
+        self.ttl = ttl
+        self.enabled = enabled
+
+    def lookup(self, phone) -> dict | None:
+        """
+        Возвращает запись телефона {"entries": [{"branch_id", "crm_id"}], "branches": [...]}
+        или None, если телефона нет в индексе.
+        """
+        phone = normalize_phone(phone)
+        if not self.enabled or not phone:
+            return None
+        try:
+            raw = get_redis_client().hget(self.key, phone)
+        except Exception as e:
+            logger.warning(f"Индекс телефонов: Redis недоступен при чтении: {e}")
+            return None
+        return self._load_record(raw) if raw else None
+
+    @staticmethod
+    def _load_record(raw) -> dict:
+        record = json.loads(raw)
+        if isinstance(record, list):
+            # Запись старого формата: полнота по филиалам неизвестна
+            return {"entries": record, "branches": []}
+        return record
+
+    def save_search_result(self, phone, branch_ids: list, customers_by_branch: dict):
+        """
+        Записывает в индекс результат полного поиска в CRM по всем филиалам branch_ids
+        (запись после промаха). Вызывается только для полного поиска: запись заменяет прежнюю
+        и считается полной по этим филиалам.
+        CRM ищет по вхождению номера, поэтому сохраняются только клиенты с точно таким телефоном.
+        """
+        phone = normalize_phone(phone)
+        if not self.enabled or not phone:
+            return
+        entries = [
+            make_entry(branch_id, customer.get("id"))
+            for branch_id, customers in customers_by_branch.items()
+            for customer in customers
+            if customer.get("id") and phone in get_customer_phones(customer)
+        ]
+
+        try:
+            redis_client = get_redis_client()
+            if not entries:
+                # Клиентов с таким телефоном нет: прежняя запись устарела
+                redis_client.hdel(self.key, phone)
+                return
+            record = {"entries": entries, "branches": sorted({str(branch_id) for branch_id in branch_ids})}
+            pipe = redis_client.pipeline()
+            pipe.hset(self.key, phone, json.dumps(record))
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Индекс телефонов: Redis недоступен при записи: {e}")
+
+    def remove_entries(self, phone, entries: list):
+        """
+        Удаляет из записи телефона клиентов, которых больше нет в CRM.
+        """
+        phone = normalize_phone(phone)
+        record = self.lookup(phone)
+        if not record:
+            return
+        removed = {get_customer_key(entry["branch_id"], entry["crm_id"]) for entry in entries}
+        record["entries"] = [
+            entry for entry in record["entries"]
+            if get_customer_key(entry["branch_id"], entry["crm_id"]) not in removed
+        ]
+
+        try:
+            if record["entries"]:
+                get_redis_client().hset(self.key, phone, json.dumps(record))
+            else:
+                get_redis_client().hdel(self.key, phone)
+        except Exception as e:
+            logger.warning(f"Индекс телефонов: Redis недоступен при записи: {e}")
+
+    def carry_over_branches(self, builder: PhoneIndexBuilder, branch_ids: set) -> PhoneIndexBuilder:
+        """
+        Переносит в собираемый индекс текущие записи указанных филиалов
+        (филиалов, которые не удалось обойти полностью).
+        """
+        if not branch_ids:
+            return builder
+        try:
+            index = get_redis_client().hgetall(self.key)
+        except Exception as e:
+            logger.warning(f"Индекс телефонов: Redis недоступен при чтении: {e}")
+            return builder
+
+        for phone, raw in index.items():
+            for entry in self._load_record(raw)["entries"]:
+                if entry["branch_id"] in branch_ids:
+                    builder.add(phone, entry["branch_id"], entry["crm_id"])
+        return builder
+
+    def replace(self, builder: PhoneIndexBuilder) -> bool:
+        """
+        Атомарно заменяет индекс собранным: данные пишутся во временный ключ, затем RENAME.
+        Записи полны только по обойденным филиалам: перенесенные записи необойденных филиалов
+        могут быть устаревшими.
+        """
+        tmp_key = f"{self.key}:tmp:{uuid.uuid4().hex}"
+        branches = sorted(builder.branches)
+        index = {
+            phone: json.dumps({"entries": list(entries.values()), "branches": branches})
+            for phone, entries in builder.entries.items()
+        }
+
+        try:
+            redis_client = get_redis_client()
+            items = list(index.items())
+            for start in range(0, len(items), PHONE_INDEX_WRITE_BATCH_SIZE):
+                redis_client.hset(tmp_key, mapping=dict(items[start:start + PHONE_INDEX_WRITE_BATCH_SIZE]))
+
+            pipe = redis_client.pipeline(transaction=True)
+            if index:
+                pipe.rename(tmp_key, self.key)
+                pipe.expire(self.key, self.ttl)
+            else:
+                pipe.delete(self.key)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Индекс телефонов: не удалось записать индекс в Redis: {e}")
+            try:
+                get_redis_client().delete(tmp_key)
+            except Exception:
+                pass
+            return False
+
+        logger.info(f"Индекс телефонов обновлен: {len(index)} телефонов")
+        return True
+
+
+phone_index = PhoneIndex()
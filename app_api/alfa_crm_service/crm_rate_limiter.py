@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Общая для всех процессов квота запросов к CRM (token bucket в Redis)
+CRM_RATE_LIMIT = float(os.getenv("CRM_RATE_LIMIT", 5))  # Запросов в секунду
+CRM_RATE_BURST = float(os.getenv("CRM_RATE_BURST", 10))  # Емкость корзины
+CRM_RATE_LIMIT_MAX_WAIT = float(os.getenv("CRM_RATE_LIMIT_MAX_WAIT", 30))  # Сколько ждать квоту, секунды
+
+# Адаптивное замедление: после каждого 429 скорость уменьшается вдвое (но не ниже минимума)
+# и возвращается к норме, если 429 не было PENALTY_TTL секунд
+PENALTY_FACTOR = 0.5
+MIN_RATE_FACTOR = 0.1
+PENALTY_TTL = 60
+
+# Вес запроса в токенах; эндпоинты, которых нет в словаре, стоят 1 токен
+ENDPOINT_WEIGHTS = {
+    "customer/create": 2,
+    "bonus/bonus-add": 2,
+}
+
+BUCKET_KEY = "crm:ratelimit:bucket"
+BLOCKED_KEY = "crm:ratelimit:blocked"
+FACTOR_KEY = "crm:ratelimit:factor"
+
+# Возвращает 0, если токены выданы, иначе - сколько секунд ждать (строкой, чтобы не потерять дробную часть)
+TOKEN_BUCKET_SCRIPT = """
+local blocked_ms = redis.call('PTTL', KEYS[2])
+if blocked_ms > 0 then
+    return tostring(blocked_ms / 1000)
+end
+
+local factor = tonumber(redis.call('GET', KEYS[3])) or 1
+local rate = tonumber(ARGV[1]) * factor
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+def get_endpoint(url: str) -> str:
+    """
+    Выделяет эндпоинт из URL CRM: https://host/v2api/1/customer/index -> customer/index
+    """
+    parts = [part for part in urlparse(url).path.split("/") if part]
+    if parts and parts[0] == "v2api":
+        parts = parts[1:]
+    if parts and parts[0].isdigit():
+        parts = parts[1:]
+    return "/".join(parts)
+
+
+class CrmRateLimiter:
+    """
+    Распределенный ограничитель запросов к CRM.
+    Состояние корзины хранится в Redis, поэтому квоту делят все веб-воркеры и воркеры Celery.
+    Если Redis недоступен, запросы пропускаются без ограничения.
+    """
+
+    def __init__(self, rate: float = CRM_RATE_LIMIT, burst: float = CRM_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._script = None
+
+    def try_acquire(self, url: str) -> float:
+        """
+        Пытается взять токены на запрос. Возвращает 0, если запрос можно выполнять,
+        иначе - сколько секунд подождать перед следующей попыткой.
+        """
+        cost = ENDPOINT_WEIGHTS.get(get_endpoint(url), 1)
+        try:
+            redis_client = get_redis_client()
+            if self._script is None:
+                self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+            wait = self._script(
+                keys=[BUCKET_KEY, BLOCKED_KEY, FACTOR_KEY],
+                args=[self.rate, self.burst, cost],
+                client=redis_client,
+            )
+            return float(wait)
+        except Exception as e:
+            logger.warning(f"Ограничитель запросов к CRM недоступен, запрос выполняется без ограничения: {e}")
+            return 0
+
+    def acquire(self, url: str, max_wait: float = CRM_RATE_LIMIT_MAX_WAIT) -> bool:
+        """
+        Ждет, пока квота позволит выполнить запрос. Возвращает False, если ждать пришлось бы дольше max_wait.
+        """
+        deadline = monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(url)
+            if wait <= 0:
+                return True
+            if monotonic() + wait > deadline:
+                logger.error(f"Квота запросов к CRM исчерпана, ожидание превысило бы {max_wait} секунд")
+                return False
+            sleep(wait)
+
+    async def acquire_async(self, url: str, max_wait: float = CRM_RATE_LIMIT_MAX_WAIT) -> bool:
+        deadline = monotonic() + max_wait
+        while True:
+            # try_acquire обращается к Redis синхронно - выполняется в потоке, чтобы не блокировать цикл
+            wait = await asyncio.to_thread(self.try_acquire, url)
+            if wait <= 0:
+                return True
+            if monotonic() + wait > deadline:
+                logger.error(f"Квота запросов к CRM исчерпана, ожидание превысило бы {max_wait} секунд")
+                return False
+            await asyncio.sleep(wait)
+
+    def report_throttled(self, retry_after: float) -> bool:
+        """
+        Фиксирует ответ 429: замедляет общую скорость и приостанавливает
+        все запросы к CRM на retry_after секунд.
+        Возвращает False, если Redis недоступен: тогда паузу нужно выдержать локально.
+        """
+        try:
+            redis_client = get_redis_client()
+            factor = float(redis_client.get(FACTOR_KEY) or 1)
+            factor = max(MIN_RATE_FACTOR, factor * PENALTY_FACTOR)
+            pipe = redis_client.pipeline()
+            pipe.set(FACTOR_KEY, factor, ex=PENALTY_TTL)
+            if retry_after > 0:
+                pipe.set(BLOCKED_KEY, 1, px=int(retry_after * 1000))
+            pipe.execute()
+            logger.warning(
+                f"CRM ответила 429: скорость снижена до {self.rate * factor:.2f} запр/с, пауза {retry_after} секунд"
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить состояние ограничителя запросов к CRM: {e}")
+            return False
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Разбирает заголовок Retry-After (в секундах). Формат с датой CRM не использует.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        return None
+
+
+crm_rate_limiter = CrmRateLimiter()
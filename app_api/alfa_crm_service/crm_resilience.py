@@ -0,0 +1,134 @@
+import logging
+import os
+import random
+from time import monotonic
+
+from app_api.alfa_crm_service.crm_rate_limiter import get_endpoint
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Эндпоинты, которые меняют данные в CRM. Повтор такого запроса после того,
+# как он мог дойти до CRM, может задвоить запись (например, начислить кибероны дважды)
+WRITE_ENDPOINTS = {
+    "customer/create",
+    "customer/update",
+    "bonus/bonus-add",
+}
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("CRM_BREAKER_FAILURE_THRESHOLD", 5))  # Ошибок в окне для размыкания
+BREAKER_WINDOW = int(os.getenv("CRM_BREAKER_WINDOW", 30))  # Окно подсчета ошибок, секунды
+BREAKER_COOLDOWN = int(os.getenv("CRM_BREAKER_COOLDOWN", 30))  # Сколько отклонять запросы после размыкания
+BREAKER_LOCAL_CHECK_INTERVAL = 1  # Как часто перечитывать состояние из Redis, секунды
+
+BREAKER_FAILURES_KEY = "crm:breaker:failures"
+BREAKER_OPEN_KEY = "crm:breaker:open"
+
+
+def is_idempotent(url: str) -> bool:
+    return get_endpoint(url) not in WRITE_ENDPOINTS
+
+
+class RetryPolicy:
+    """
+    Политика повторов запросов к CRM.
+    Задержка - экспоненциальная с полным джиттером, чтобы воркеры не повторяли запросы синхронно.
+    Статусы из retryable_statuses и сетевые ошибки повторяются только для идемпотентных запросов;
+    429 и ошибки установки соединения (запрос точно не дошел до CRM) повторяются всегда.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = int(os.getenv("CRM_MAX_RETRIES", 5)),
+        base_delay: float = float(os.getenv("CRM_RETRY_DELAY", 2)),
+        max_delay: float = float(os.getenv("CRM_RETRY_MAX_DELAY", 30)),
+        retryable_statuses: frozenset = frozenset({500, 502, 503, 504}),
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable_statuses = retryable_statuses
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_retry_status(self, status_code: int, idempotent: bool) -> bool:
+        if status_code == 429:
+            return True
+        return idempotent and status_code in self.retryable_statuses
+
+    def should_retry_error(self, connect_failed: bool, idempotent: bool) -> bool:
+        return connect_failed or idempotent
+
+
+class CrmCircuitBreaker:
+    """
+    Размыкатель цепи для запросов к CRM, общий для всех процессов через Redis.
+    Если за BREAKER_WINDOW секунд накопилось BREAKER_FAILURE_THRESHOLD ошибок (сеть, 5xx),
+    все запросы к CRM отклоняются сразу в течение BREAKER_COOLDOWN секунд.
+    Если Redis недоступен, запросы пропускаются.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        window: int = BREAKER_WINDOW,
+        cooldown: int = BREAKER_COOLDOWN,
+    ):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.cooldown = cooldown
+        # Локальная копия состояния, чтобы не ходить в Redis перед каждым запросом
+        self._open_until = 0.0
+        self._checked_at = float("-inf")
+
+    def reset_local_state(self):
+        """
+        Забывает локальную копию состояния: следующая проверка пойдет в Redis.
+        """
+        self._open_until = 0.0
+        self._checked_at = float("-inf")
+
+    def allow_request(self) -> bool:
+        now = monotonic()
+        if now < self._open_until:
+            return False
+        if now - self._checked_at < BREAKER_LOCAL_CHECK_INTERVAL:
+            return True
+
+        try:
+            ttl = get_redis_client().ttl(BREAKER_OPEN_KEY)
+        except Exception as e:
+            logger.warning(f"Состояние размыкателя CRM недоступно: {e}")
+            return True
+
+        self._checked_at = now
+        if ttl and ttl > 0:
+            self._open_until = now + ttl
+            return False
+        return True
+
+    def record_failure(self):
+        try:
+            redis_client = get_redis_client()
+            pipe = redis_client.pipeline()
+            # Окно начинается с первой ошибки: ключ создается с TTL только если его еще нет
+            pipe.set(BREAKER_FAILURES_KEY, 0, ex=self.window, nx=True)
+            pipe.incr(BREAKER_FAILURES_KEY)
+            _, failures = pipe.execute()
+            if failures >= self.failure_threshold:
+                pipe = redis_client.pipeline()
+                pipe.set(BREAKER_OPEN_KEY, 1, ex=self.cooldown)
+                pipe.delete(BREAKER_FAILURES_KEY)
+                pipe.execute()
+                self._open_until = monotonic() + self.cooldown
+                logger.error(
+                    f"CRM недоступна: {failures} ошибок за {self.window} секунд. "
+                    f"Запросы отклоняются {self.cooldown} секунд."
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить ошибку в размыкателе CRM: {e}")
+
+
+crm_retry_policy = RetryPolicy()
+crm_circuit_breaker = CrmCircuitBreaker()
@@ -0,0 +1,137 @@
+import copy
+import logging
+import os
+from urllib.parse import parse_qs, urlparse
+
+from app_api.alfa_crm_service.crm_rate_limiter import get_endpoint
+from app_api.alfa_crm_service.crm_single_flight import make_request_key
+from app_api.utils.util_cache import TwoLevelCache
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# TTL ответов CRM по эндпоинтам, секунды. Эндпоинты, которых нет в словаре, не кэшируются
+RESPONSE_CACHE_TTLS = {
+    "customer/index": 60,
+    "lesson/index": 60,
+    "cgi/customer": 5 * 60,
+    "group/index": 5 * 60,
+    "subject/index": 60 * 60,
+    "bonus/balance-bonus": 60,
+}
+RESPONSE_CACHE_ENABLED = os.getenv("CRM_RESPONSE_CACHE_ENABLED", "True") == "True"
+# L1 живет недолго, чтобы сброс ключей после записи быстро доходил до других процессов
+RESPONSE_CACHE_LOCAL_TTL = 10
+RESPONSE_CACHE_LOCAL_ENTRIES = 512
+
+TAG_KEY_PREFIX = "crm:response_tag"
+
+
+def _get_request_value(name: str, url: str, data: dict | None, params: dict | None):
+    for source in (data or {}, params or {}):
+        if source.get(name) not in (None, ""):
+            return source[name]
+    values = parse_qs(urlparse(url).query).get(name)
+    return values[0] if values else None
+
+
+def get_request_tags(url: str, data: dict | None, params: dict | None) -> list[str]:
+    """
+    Теги запроса - клиент и телефон, к которым относится ответ.
+    По тегам запись в CRM сбрасывает все закэшированные ответы о том же клиенте.
+    """
+    tags = []
+    customer_id = _get_request_value("customer_id", url, data, params)
+    if customer_id is None and get_endpoint(url).startswith("customer/"):
+        customer_id = _get_request_value("id", url, data, params)
+    if customer_id is not None:
+        tags.append(f"customer:{customer_id}")
+
+    phone = _get_request_value("phone", url, data, params)
+    if phone is not None:
+        tags.append(f"phone:{phone}")
+    return tags
+
+
+class CrmResponseCache:
+    """
+    Кэш ответов CRM на чтение: L1 - LRU в памяти процесса, L2 - Redis.
+    Ключ - эндпоинт и хэш URL с каноническим JSON данных и параметров.
+    """
+
+    def __init__(self, ttls: dict = RESPONSE_CACHE_TTLS, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.enabled = enabled
+        self._caches = {
+            endpoint: TwoLevelCache(
+                f"crm:response:{endpoint}",
+                ttl,
+                local_ttl=RESPONSE_CACHE_LOCAL_TTL,
+                max_local_entries=RESPONSE_CACHE_LOCAL_ENTRIES,
+            )
+            for endpoint, ttl in ttls.items()
+        }
+
+    def _get_cache(self, url: str) -> TwoLevelCache | None:
+        if not self.enabled:
+            return None
+        return self._caches.get(get_endpoint(url))
+
+    def get(self, url: str, data: dict | None, params: dict | None) -> dict | None:
+        cache = self._get_cache(url)
+        if cache is None:
+            return None
+        value = cache.get(make_request_key(url, data, params))
+        if value is not None:
+            logger.debug(f"Ответ CRM взят из кэша. URL: {url}")
+            # Копия: вызывающий код может менять ответ
+            return copy.deepcopy(value)
+        return None
+
+    def set(self, url: str, data: dict | None, params: dict | None, value: dict):
+        cache = self._get_cache(url)
+        if cache is None:
+            return
+        key = make_request_key(url, data, params)
+        cache.set(key, value)
+
+        tags = get_request_tags(url, data, params)
+        if not tags:
+            return
+        try:
+            pipe = get_redis_client().pipeline()
+            for tag in tags:
+                tag_key = f"{TAG_KEY_PREFIX}:{tag}"
+                pipe.sadd(tag_key, f"{get_endpoint(url)}|{key}")
+                pipe.expire(tag_key, max(RESPONSE_CACHE_TTLS.values()))
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить теги ответа CRM: {e}")
+
+    def invalidate(self, url: str, data: dict | None, params: dict | None):
+        """
+        Сбрасывает закэшированные ответы о клиенте (телефоне), которого затронула запись в CRM.
+        """
+        if not self.enabled:
+            return
+        for tag in get_request_tags(url, data, params):
+            self.invalidate_tag(tag)
+
+    def invalidate_tag(self, tag: str):
+        tag_key = f"{TAG_KEY_PREFIX}:{tag}"
+        try:
+            redis_client = get_redis_client()
+            members = redis_client.smembers(tag_key)
+            redis_client.delete(tag_key)
+        except Exception as e:
+            logger.warning(f"Не удалось сбросить кэш ответов CRM по тегу {tag}: {e}")
+            return
+
+        for member in members:
+            endpoint, _, key = member.partition("|")
+            cache = self._caches.get(endpoint)
+            if cache is not None:
+                cache.delete(key)
+        logger.info(f"Сброшено закэшированных ответов CRM по тегу {tag}: {len(members)}")
+
+
+crm_response_cache = CrmResponseCache()
@@ -1,19 +1,36 @@
 import json
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
-from time import sleep
+from time import monotonic, sleep, time
 import redis
 from celery_app import app
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from app_api.alfa_crm_service.crm_paginator import PAGINATOR_CONCURRENCY, CrmPageError, iter_pages
+from app_api.alfa_crm_service.crm_phone_index import get_customer_phones, normalize_phone, phone_index
+from app_api.alfa_crm_service.crm_rate_limiter import crm_rate_limiter, parse_retry_after
+from app_api.alfa_crm_service.crm_resilience import crm_circuit_breaker, crm_retry_policy, is_idempotent
+from app_api.alfa_crm_service.crm_response_cache import crm_response_cache
+from app_api.alfa_crm_service.crm_single_flight import crm_single_flight, make_request_key
+from app_api.utils.util_cache import TwoLevelCache
+from app_api.utils.util_redis import get_redis_client
+from app_kiberclub.models import Branch
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 CRM_HOSTNAME = os.getenv("CRM_HOSTNAME")
+# http - для локального тестового сервера CRM (fake_crm_server)
+CRM_SCHEME = os.getenv("CRM_SCHEME", "https")
+CRM_BASE_URL = f"{CRM_SCHEME}://{CRM_HOSTNAME}"
 CRM_EMAIL = os.getenv("CRM_EMAIL")
 CRM_API_KEY = os.getenv("CRM_API_KEY")
 
@@ -24,19 +41,108 @@ BASE_HEADERS = {
     "Accept": "application/json, text/plain, */*",
 }
 
-branches = [1]
 client_is_study_statuses = [0, 1]
+# Филиалы для поиска, если таблица Branch пуста
+DEFAULT_SEARCH_BRANCHES = ["1"]
 
-REQUEST_LIMIT = 2  # Максимальное количество одновременных запросов
-MAX_RETRIES = 5  # Максимальное количество попыток
-RETRY_DELAY = 2  # Начальная задержка между попытками
+PHONE_SEARCH_CONCURRENCY = int(os.getenv("CRM_PHONE_SEARCH_CONCURRENCY", 8))  # Одновременных запросов при поиске по телефону
+PHONE_SEARCH_DEADLINE = float(os.getenv("CRM_PHONE_SEARCH_DEADLINE", 8))  # Общее время на поиск по телефону, секунды
+REQUEST_TIMEOUT = 10  # Таймаут одного запроса к CRM, секунды
 
+# Пул keep-alive соединений к CRM на один процесс (воркер gunicorn / Celery)
+CRM_POOL_CONNECTIONS = int(os.getenv("CRM_POOL_CONNECTIONS", 2))
+CRM_POOL_MAXSIZE = int(os.getenv("CRM_POOL_MAXSIZE", 10))
 
-def get_redis_client():
+_crm_session: requests.Session | None = None
+_crm_session_pid: int | None = None
+_crm_session_lock = threading.Lock()
+
+
+def _reset_crm_session():
+    """
+    Сбрасывает HTTP-сессию CRM в дочернем процессе после fork.
+    Сокеты родителя не должны использоваться в воркерах Celery (prefork).
+    """
+    global _crm_session, _crm_session_pid, _crm_session_lock
+    _crm_session = None
+    _crm_session_pid = None
+    _crm_session_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_crm_session)
+
+
+def get_crm_session() -> requests.Session:
+    """
+    Возвращает общую для процесса HTTP-сессию к CRM.
+    Сессия держит пул keep-alive соединений, поэтому TCP+TLS рукопожатие
+    выполняется один раз, а не на каждый запрос.
+    """
+    global _crm_session, _crm_session_pid
+    pid = os.getpid()
+    if _crm_session is None or _crm_session_pid != pid:
+        with _crm_session_lock:
+            if _crm_session is None or _crm_session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=CRM_POOL_CONNECTIONS,
+                    pool_maxsize=CRM_POOL_MAXSIZE,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(BASE_HEADERS)
+                _crm_session = session
+                _crm_session_pid = pid
+                logger.info(
+                    f"Создана HTTP-сессия CRM для процесса {pid} (pool_maxsize={CRM_POOL_MAXSIZE})"
+                )
+    return _crm_session
+
+
+CRM_TOKEN_KEY = "crm_token"
+CRM_TOKEN_LOCK_KEY = "crm_token:lock"
+CRM_TOKEN_TTL = 3300  # 55 минут
+CRM_TOKEN_LOCK_TIMEOUT = 30  # Максимальное время удержания блокировки авторизации
+CRM_TOKEN_WAIT_TIMEOUT = 15  # Сколько ждать токен, который получает другой воркер
+CRM_TOKEN_POLL_INTERVAL = 0.2
+
+# L1: токен в памяти процесса, срок жизни повторяет TTL ключа в Redis (L2)
+_token_cache = {"token": None, "expires_at": 0.0}
+
+
+def _cache_token_locally(token: str, ttl: int):
+    _token_cache["token"] = token
+    _token_cache["expires_at"] = monotonic() + max(ttl, 0)
+
+
+def clear_local_token():
     """
-    Создает и возвращает клиент Redis.
+    Сбрасывает L1-копию токена CRM в памяти процесса.
     """
-    return redis.StrictRedis(host="localhost", port=6379, db=0, decode_responses=True)
+    _token_cache["token"] = None
+    _token_cache["expires_at"] = 0.0
+
+
+def _save_token(redis_client, token: str):
+    # Сохраняем токен в Redis с TTL 55 минут (3300 секунд)
+    redis_client.set(CRM_TOKEN_KEY, token, ex=CRM_TOKEN_TTL)
+    _cache_token_locally(token, CRM_TOKEN_TTL)
+
+
+def _read_token_from_redis(redis_client) -> str | None:
+    """
+    Читает токен и его оставшийся TTL из Redis за один round-trip
+    и кладет токен в L1 на оставшееся время.
+    """
+    pipe = redis_client.pipeline()
+    pipe.get(CRM_TOKEN_KEY)
+    pipe.ttl(CRM_TOKEN_KEY)
+    token, ttl = pipe.execute()
+    if token and ttl and ttl > 0:
+        _cache_token_locally(token, ttl)
+        return token
+    return None
 
 
 @app.task
@@ -46,36 +152,83 @@ def update_crm_token():
     """
     token = login_to_alfa_crm()
     if token:
-        # Сохраняем токен в Redis с TTL 55 минут (3300 секунд)
-        redis_client = get_redis_client()
-        redis_client.set("crm_token", token, ex=3300)
+        _save_token(get_redis_client(), token)
         logger.info("Токен успешно обновлен и сохранен в Redis.")
     else:
         logger.error("Не удалось обновить токен.")
 
 
-def get_crm_token():
+def invalidate_crm_token(token: str | None):
     """
-    Получение токена из Redis или через авторизацию.
+    Сбрасывает токен, который CRM отклонила (401).
+    Ключ в Redis удаляется только если там лежит тот же токен,
+    чтобы не стереть уже обновленный другим воркером.
     """
+    if _token_cache["token"] == token:
+        _token_cache["token"] = None
+        _token_cache["expires_at"] = 0.0
+
     redis_client = get_redis_client()
-    token = redis_client.get("crm_token")
+    if token and redis_client.get(CRM_TOKEN_KEY) == token:
+        redis_client.delete(CRM_TOKEN_KEY)
+        logger.info("Недействительный токен удален из Redis.")
+
 
+def get_crm_token():
+    """
+    Получение токена: из памяти процесса (L1), из Redis (L2) или через авторизацию.
+    Авторизацию выполняет только один воркер (распределенная блокировка в Redis),
+    остальные ждут, пока новый токен появится в Redis.
+    """
+    if _token_cache["token"] and _token_cache["expires_at"] > monotonic():
+        return _token_cache["token"]
+
+    redis_client = get_redis_client()
+    token = _read_token_from_redis(redis_client)
     if token:
         logger.info("Токен успешно получен из Redis.")
         return token
-    else:
-        logger.info("Токен отсутствует в Redis. Запрашиваем новый токен...")
-        token = login_to_alfa_crm()
+
+    logger.info("Токен отсутствует в Redis. Запрашиваем новый токен...")
+    lock = redis_client.lock(CRM_TOKEN_LOCK_KEY, timeout=CRM_TOKEN_LOCK_TIMEOUT)
+    if lock.acquire(blocking=False):
+        try:
+            # Токен мог появиться, пока мы брали блокировку
+            token = _read_token_from_redis(redis_client)
+            if token:
+                return token
+
+            token = login_to_alfa_crm()
+            if token:
+                _save_token(redis_client, token)
+                logger.info("Новый токен сохранен в Redis.")
+                return token
+            logger.error("Не удалось получить токен.")
+            return None
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                logger.warning("Блокировка авторизации в CRM истекла до освобождения.")
+
+    # Авторизацию выполняет другой воркер - ждем его токен
+    deadline = monotonic() + CRM_TOKEN_WAIT_TIMEOUT
+    while monotonic() < deadline:
+        sleep(CRM_TOKEN_POLL_INTERVAL)
+        # Блокировка проверяется до чтения токена: воркер сначала сохраняет токен, потом освобождает блокировку
+        lock_held = redis_client.exists(CRM_TOKEN_LOCK_KEY)
+        token = _read_token_from_redis(redis_client)
         if token:
-            # Сохраняем токен в Redis с TTL 55 минут (3300 секунд)
-            redis_client.set("crm_token", token, ex=3300)
-            logger.info("Новый токен сохранен в Redis.")
+            logger.info("Получен токен, обновленный другим воркером.")
             return token
-        else:
-            logger.error("Не удалось получить токен.")
+        if not lock_held:
+            # Блокировка освобождена без нового токена - авторизация у другого воркера не удалась
+            logger.error("Другой воркер не смог получить токен. Ожидание прекращено.")
             return None
 
+    logger.error("Не дождались токена от другого воркера.")
+    return None
+
 
 def login_to_alfa_crm():
     """
@@ -86,13 +239,18 @@ def login_to_alfa_crm():
     logger.info(f"Начинается авторизация в CRM с email: {email}...")
 
     data = {"email": email, "api_key": api_key}
-    url = f"https://{CRM_HOSTNAME}/v2api/auth/login"
+    url = f"{CRM_BASE_URL}/v2api/auth/login"
     logger.debug(f"URL для авторизации: {url}")
     logger.debug(f"Данные для авторизации: {data}")
 
     try:
         logger.info("Отправка POST-запроса для авторизации...")
-        response = requests.post(url, headers=BASE_HEADERS, json=data)
+        if not crm_circuit_breaker.allow_request():
+            logger.error("CRM временно недоступна, авторизация отложена.")
+            return None
+        if not crm_rate_limiter.acquire(url):
+            return None
+        response = get_crm_session().post(url, json=data, timeout=REQUEST_TIMEOUT)
         logger.debug(
             f"Получен ответ от сервера: статус {response.status_code}, тело: {response.text}"
         )
@@ -110,18 +268,49 @@ def login_to_alfa_crm():
         return None
 
 
-def find_user_by_phone(phone_number: str) -> dict | None:
+def get_crm_branch_ids() -> list:
+    """
+    Возвращает ID филиалов в CRM из таблицы Branch.
+    """
+    return list(Branch.objects.exclude(branch_id__isnull=True).exclude(branch_id="").values_list("branch_id", flat=True))
+
+
+def get_search_branch_ids() -> list:
+    return get_crm_branch_ids() or DEFAULT_SEARCH_BRANCHES
+
+
+def find_user_by_phone(
+    phone_number: str,
+    first_match: bool = False,
+    deadline: float = PHONE_SEARCH_DEADLINE,
+) -> dict | None:
     """
     Поиск пользователя по номеру телефона.
+    Сначала используется локальный индекс телефонов, затем - поиск в CRM по всем филиалам
+    из таблицы Branch и статусам is_study. Запросы выполняются конкурентно, ответы
+    обрабатываются по мере готовности.
+    first_match=True - вернуть первый ответ с найденными клиентами, не дожидаясь остальных
+    (когда нужно только знать, есть ли клиент в CRM).
+    deadline - общее время на поиск в CRM, секунды. Если ответы получены не от всех филиалов
+    (в том числе после досрочного выхода по first_match), в результате complete=False:
+    список клиентов в таком ответе неполный, и по нему нельзя удалять связи с клиентами.
+    Ответ индекса полон, только если запись телефона покрывает все филиалы поиска;
+    иначе без first_match выполняется полный поиск в CRM.
     """
     logger.info(f"Начинается поиск пользователя по номеру телефона: {phone_number}")
 
+    search_branches = [str(branch) for branch in get_search_branch_ids()]
+    result_answer = find_user_by_phone_in_index(phone_number, search_branches)
+    if result_answer is not None and (result_answer["complete"] or first_match):
+        logger.info(f"Пользователь найден в индексе телефонов: {result_answer['total']} клиентов")
+        return result_answer
+
     def fetch_data(branch: str, status: int) -> dict | None:
         """
         Выполнение одного запроса к CRM.
         """
         data = {"is_study": status, "page": 0, "phone": phone_number}
-        url = f"https://{CRM_HOSTNAME}/v2api/{branch}/customer/index"
+        url = f"{CRM_BASE_URL}/v2api/{branch}/customer/index"
         logger.info(
             f"Выполняется запрос для branch={branch}, status={status}, URL: {url}"
         )
@@ -137,28 +326,46 @@ def find_user_by_phone(phone_number: str) -> dict | None:
         return response
 
     tasks = [
-        (str(branch), status)
+        (branch, status)
         for status in client_is_study_statuses
-        for branch in branches
+        for branch in search_branches
     ]
     logger.info(
         f"Сформированы задачи для выполнения: {len(tasks)} комбинаций филиалов и статусов."
     )
 
     results = []
-    with ThreadPoolExecutor(max_workers=REQUEST_LIMIT) as executor:
-        logger.info(
-            f"Запуск выполнения задач с ограничением {REQUEST_LIMIT} одновременных запросов."
-        )
-        futures = [
-            executor.submit(fetch_data, branch, status) for branch, status in tasks
-        ]
-        for future in futures:
+    found_by_branch: dict = {}
+    complete = True
+    # Не используем with: выход из блока ждал бы завершения всех запросов, в том числе после дедлайна
+    executor = ThreadPoolExecutor(max_workers=min(PHONE_SEARCH_CONCURRENCY, len(tasks)) or 1)
+    try:
+        futures = {executor.submit(fetch_data, branch, status): branch for branch, status in tasks}
+        for future in as_completed(futures, timeout=deadline):
+            branch = futures[future]
             result = future.result()
-            if result is not None:
-                results.append(result)
-            else:
+            if result is None:
+                complete = False
                 logger.warning("Получен пустой результат, пропускаем.")
+                continue
+
+            results.append(result)
+            found_by_branch.setdefault(branch, []).extend(result.get("items", []))
+            if first_match and result.get("total", 0) > 0:
+                logger.info(f"Клиент найден в филиале {branch}, остальные запросы не ждем")
+                # Клиенты остальных филиалов не получены - список неполный
+                complete = len(results) == len(tasks)
+                break
+    except FuturesTimeoutError:
+        complete = False
+        logger.warning(f"Поиск по телефону не уложился в {deadline} с, возвращаем полученные ответы")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if complete:
+        # Результат полного поиска записываем в индекс, чтобы следующий поиск был локальным.
+        # Неполный (дедлайн, ошибка филиала, досрочный выход) не записываем: индекс скрыл бы остальных клиентов
+        phone_index.save_search_result(phone_number, search_branches, found_by_branch)
 
     # Обработка результатов
     total_sum = sum(result.get("total", 0) for result in results)
@@ -169,10 +376,58 @@ def find_user_by_phone(phone_number: str) -> dict | None:
         "total": total_sum,
         "count": count_sum,
         "items": all_items,
+        "complete": complete,
     }
     return result_answer
 
 
+def find_user_by_phone_in_index(phone_number: str, branch_ids: list) -> dict | None:
+    """
+    Поиск клиентов по номеру телефона в локальном индексе (см. crm_phone_index).
+    Индекс дает только филиал и crm_id; карточки клиентов запрашиваются по ID конкурентно
+    (ответы customer/index кэшируются ненадолго, см. crm_response_cache).
+    Клиенты, которых больше нет в CRM, удаляются из индекса.
+    Возвращает ответ в формате customer/index или None, если индекс не может ответить
+    и нужен поиск в CRM. complete=True - запись телефона покрывает все филиалы branch_ids.
+    """
+    # Импорт здесь: crm_service_async сам импортирует этот модуль
+    from app_api.alfa_crm_service.crm_service_async import run_concurrently
+
+    record = phone_index.lookup(phone_number)
+    if not record or not record["entries"]:
+        return None
+
+    entries = record["entries"]
+    customers = run_concurrently(
+        lambda crm: [crm.get_customer(entry["branch_id"], entry["crm_id"]) for entry in entries]
+    )
+
+    phone = normalize_phone(phone_number)
+    items = []
+    missing = []
+    outdated = False
+    for entry, customer in zip(entries, customers):
+        if customer is None:
+            logger.warning(f"Не удалось получить клиента {entry['crm_id']} из индекса телефонов, поиск в CRM")
+            return None
+        if not customer:
+            logger.info(f"Клиента {entry['crm_id']} из индекса телефонов нет в CRM, запись удаляется")
+            missing.append(entry)
+        # Телефон клиента мог измениться после сборки индекса
+        elif phone in get_customer_phones(customer):
+            items.append(customer)
+        else:
+            outdated = True
+
+    if missing:
+        phone_index.remove_entries(phone, missing)
+    if not items:
+        return None
+    # Устаревшая запись могла пропустить и новых клиентов с этим телефоном
+    complete = not outdated and set(branch_ids) <= set(record["branches"])
+    return {"total": len(items), "count": len(items), "items": items, "complete": complete}
+
+
 def create_user_in_crm(user_data) -> dict | None:
     """
     Создание нового пользователя в CRM.
@@ -190,7 +445,7 @@ def create_user_in_crm(user_data) -> dict | None:
         "is_study": 0,
         "note": "created by Telegram BOT",
     }
-    url = f"https://{CRM_HOSTNAME}/v2api/1/customer/create"
+    url = f"{CRM_BASE_URL}/v2api/1/customer/create"
 
     logger.info(f"Отправка данных для создания пользователя: {data}")
     try:
@@ -207,74 +462,164 @@ def create_user_in_crm(user_data) -> dict | None:
 
 
 def send_request_to_crm(url: str, data: dict, params: dict | None) -> dict | None:
+    if not is_idempotent(url):
+        response = _send_request_to_crm(url, data, params)
+        # Запись могла дойти до CRM даже без успешного ответа - сбрасываем кэш в любом случае
+        crm_response_cache.invalidate(url, data, params)
+        return response
+
+    cached = crm_response_cache.get(url, data, params)
+    if cached is not None:
+        return cached
+
+    # Одинаковые одновременные чтения выполняются одним запросом к CRM
+    key = make_request_key(url, data, params)
+    return crm_single_flight.do(key, lambda: _fetch_and_cache(url, data, params))
+
+
+def _fetch_and_cache(url: str, data: dict, params: dict | None) -> dict | None:
+    response = _send_request_to_crm(url, data, params)
+    if response is not None:
+        crm_response_cache.set(url, data, params, response)
+    return response
+
+
+def _send_request_to_crm(url: str, data: dict, params: dict | None) -> dict | None:
+    if not crm_circuit_breaker.allow_request():
+        logger.error(f"CRM временно недоступна, запрос отклонен без отправки. URL: {url}")
+        return None
+
     token = get_crm_token()
     if not token:
         logger.error("Токен отсутствует. Отмена запроса.")
         return None
 
-    headers = {**BASE_HEADERS, "X-ALFACRM-TOKEN": token}
-    retry_delay = RETRY_DELAY
+    headers = {"X-ALFACRM-TOKEN": token}
+    idempotent = is_idempotent(url)
+    token_refreshed = False
     logger.info(
         f"Начинается отправка запроса к CRM. URL: {url}, Данные: {data}, Параметры: {params}"
     )
 
-    for attempt in range(MAX_RETRIES):
+    for attempt in range(crm_retry_policy.max_retries):
+        is_last_attempt = attempt + 1 == crm_retry_policy.max_retries
+        if attempt and not crm_circuit_breaker.allow_request():
+            logger.error("CRM временно недоступна. Повторы прекращены.")
+            return None
+
+        logger.info(
+            f"Попытка {attempt + 1}/{crm_retry_policy.max_retries}. Отправка POST-запроса..."
+        )
+        # Общая квота запросов к CRM для всех процессов
+        if not crm_rate_limiter.acquire(url):
+            return None
+
         try:
-            logger.info(
-                f"Попытка {attempt + 1}/{MAX_RETRIES}. Отправка POST-запроса..."
+            response = get_crm_session().post(
+                url,
+                headers=headers,
+                json=data,
+                params=params,
+                timeout=REQUEST_TIMEOUT,
             )
-            with ThreadPoolExecutor(max_workers=REQUEST_LIMIT) as executor:
-                future = executor.submit(
-                    requests.post,
-                    url,
-                    headers=headers,
-                    json=data,
-                    params=params,
-                    timeout=10,
-                )
-                response = future.result()
+        except requests.RequestException as e:
+            crm_circuit_breaker.record_failure()
+            # ConnectTimeout - соединение не установлено, запрос точно не дошел до CRM
+            connect_failed = isinstance(e, requests.ConnectTimeout)
+            if not is_last_attempt and crm_retry_policy.should_retry_error(connect_failed, idempotent):
+                delay = crm_retry_policy.get_delay(attempt)
+                logger.warning(f"Ошибка при отправке запроса: {e}. Повторная попытка через {delay:.1f} секунд...")
+                sleep(delay)
+                continue
+            logger.error(f"Ошибка при отправке запроса: {e}")
+            return None
 
-            logger.debug(
-                f"Получен ответ от сервера: статус {response.status_code}, тело: {response.text}"
-            )
+        logger.debug(
+            f"Получен ответ от сервера: статус {response.status_code}, тело: {response.text}"
+        )
 
-            if response.status_code == 200:
-                logger.info("Запрос успешно выполнен.")
-                try:
-                    return response.json()
-                except json.JSONDecodeError:
-                    logger.error("Ошибка декодирования JSON. Ответ: %s", response.text)
-                    return None
-            elif response.status_code == 401:
+        if response.status_code >= 500:
+            crm_circuit_breaker.record_failure()
+
+        if response.status_code == 200:
+            logger.info("Запрос успешно выполнен.")
+            try:
+                return response.json()
+            except json.JSONDecodeError:
+                logger.error("Ошибка декодирования JSON. Ответ: %s", response.text)
+                return None
+        elif response.status_code == 401:
+            if token_refreshed:
                 logger.error("Неавторизованный запрос. Отмена запроса.")
                 return None
-            elif response.status_code == 429:
-                logger.warning(
-                    f"Слишком много запросов. Повторная попытка через {retry_delay} секунд..."
-                )
-                sleep(retry_delay)
-                retry_delay *= 2
-                continue
-            else:
-                logger.error(
-                    f"Неожиданный статус: {response.status_code}. Тело: {response.text}"
-                )
+            # Токен отозван или истек раньше TTL - получаем новый и повторяем один раз
+            logger.warning("Неавторизованный запрос. Обновляем токен и повторяем запрос...")
+            invalidate_crm_token(token)
+            token = get_crm_token()
+            if not token:
+                logger.error("Токен отсутствует. Отмена запроса.")
                 return None
-        except requests.RequestException as e:
-            logger.error(f"Ошибка при отправке запроса: {e}")
+            headers = {"X-ALFACRM-TOKEN": token}
+            token_refreshed = True
+            continue
+        elif response.status_code == 429:
+            # Пауза действует для всех процессов: следующий acquire дождется ее окончания
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            pause = retry_after if retry_after is not None else crm_retry_policy.get_delay(attempt)
+            logger.warning(
+                f"Слишком много запросов. Повторная попытка через {pause:.1f} секунд..."
+            )
+            if not crm_rate_limiter.report_throttled(pause):
+                # Без Redis общая пауза не действует - ждем в этом процессе
+                sleep(pause)
+            continue
+        elif not is_last_attempt and crm_retry_policy.should_retry_status(response.status_code, idempotent):
+            delay = crm_retry_policy.get_delay(attempt)
+            logger.warning(
+                f"Статус {response.status_code}. Повторная попытка через {delay:.1f} секунд..."
+            )
+            sleep(delay)
+            continue
+        else:
+            logger.error(
+                f"Неожиданный статус: {response.status_code}. Тело: {response.text}"
+            )
             return None
 
     logger.error("Достигнуто максимальное количество попыток. Запрос не выполнен.")
     return None
 
 
-def get_client_lessons(
+def iter_crm_index(
+    url: str,
+    data: dict | None = None,
+    params: dict | None = None,
+    concurrency: int = PAGINATOR_CONCURRENCY,
+    stop_when=None,
+    max_pages: int | None = None,
+):
+    """
+    Обходит все страницы index-метода CRM и отдает записи по одной.
+    Страницы после первой запрашиваются конкурентно (см. crm_paginator.iter_pages).
+    """
+
+    def fetch_page(page: int) -> dict | None:
+        return send_request_to_crm(url, {**(data or {}), "page": page}, params)
+
+    return iter_pages(fetch_page, concurrency=concurrency, stop_when=stop_when, max_pages=max_pages)
+
+
+def fetch_client_lessons(
     user_crm_id: int,
     branch_id: int,
     page: int | None = None,
     lesson_status: int = 1,
     lesson_type: int = 2,
 ) -> dict | None:
+    """
+    Запрашивает уроки клиента. В отличие от get_client_lessons, при ошибке CRM возвращает None,
+    чтобы ошибку можно было отличить от отсутствия уроков.
+    """
     data = {
         "customer_id": user_crm_id,
         "status": lesson_status,  # 1 - запланирован урок, 2 - отменен, 3 - проведен
@@ -282,7 +627,7 @@ def get_client_lessons(
         "page": 0 if page is None else page,
     }
 
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/lesson/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/lesson/index"
 
     response_data: dict | None = send_request_to_crm(url, data, params=None)
     if response_data:
@@ -291,14 +636,75 @@ def get_client_lessons(
             return response_data
         else:
             logger.error(f"Некорректный ответ от CRM: {response_data}")
-            return {"total": 0}
+            return None
     else:
         logger.warning(f"Не удалось получить данные уроков")
-        return {"total": 0}
+        return None
+
+
+def get_client_lessons(
+    user_crm_id: int,
+    branch_id: int,
+    page: int | None = None,
+    lesson_status: int = 1,
+    lesson_type: int = 2,
+) -> dict | None:
+    response_data = fetch_client_lessons(user_crm_id, branch_id, page, lesson_status, lesson_type)
+    return response_data if response_data is not None else {"total": 0}
+
+
+LESSON_COUNT_TTL = int(os.getenv("CRM_LESSON_COUNT_TTL", 5 * 60))
+
+# Счетчики уроков клиента: ключ "{branch_id}:{customer_id}:{status}:{lesson_type}",
+# значение {"total": всего уроков, "count": размер страницы}
+lesson_count_cache = TwoLevelCache("crm:lesson_count", LESSON_COUNT_TTL)
+
+
+def get_lesson_count_key(user_crm_id, branch_id, lesson_status: int, lesson_type: int) -> str:
+    return f"{branch_id}:{user_crm_id}:{lesson_status}:{lesson_type}"
+
+
+def lesson_counters(response_data: dict | None) -> dict | None:
+    """
+    Оставляет от страницы уроков только счетчики.
+    """
+    if not isinstance(response_data, dict) or "total" not in response_data:
+        return None
+    return {"total": response_data.get("total", 0), "count": response_data.get("count", 0)}
+
+
+def get_lesson_counters(user_crm_id, branch_id, lesson_status: int = 1, lesson_type: int = 2) -> dict | None:
+    """
+    Счетчики уроков клиента {"total", "count"} без самих уроков.
+    Запрашивается первая страница, в кэш (на LESSON_COUNT_TTL) попадают только счетчики.
+    При ошибке CRM возвращает None.
+    """
+    return lesson_count_cache.get_or_set(
+        get_lesson_count_key(user_crm_id, branch_id, lesson_status, lesson_type),
+        lambda: lesson_counters(fetch_client_lessons(user_crm_id, branch_id, 0, lesson_status, lesson_type)),
+    )
+
+
+def get_lesson_count(user_crm_id, branch_id, lesson_status: int = 1, lesson_type: int = 2) -> int:
+    counters = get_lesson_counters(user_crm_id, branch_id, lesson_status, lesson_type)
+    return counters["total"] if counters else 0
+
+
+def has_scheduled_lessons_from_customer(customer: dict) -> bool | None:
+    """
+    Определяет наличие запланированных уроков по карточке клиента без запроса к CRM.
+    Пустая next_lesson_date - запланированных уроков нет. Заполненная дата может относиться
+    и к пробному уроку, поэтому в этом случае (и если поля нет) возвращается None - нужен подсчет уроков.
+    """
+    if "next_lesson_date" not in customer:
+        return None
+    if not customer.get("next_lesson_date"):
+        return False
+    return None
 
 
 def get_curr_tariff(user_crm_id, branch_id, curr_date):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer-tariff/index?customer_id={user_crm_id}"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/customer-tariff/index?customer_id={user_crm_id}"
     customer_tariffs = send_request_to_crm(url, {}, None)
     for tariff in sorted(customer_tariffs.get("items"), key=lambda x: datetime.strptime(x.get("e_date"), "%d.%m.%Y")):
         tariff_end_date = datetime.strptime(tariff.get("e_date"), "%d.%m.%Y")
@@ -310,54 +716,103 @@ def get_curr_tariff(user_crm_id, branch_id, curr_date):
             return tariff
 
 
+TARIFF_CATALOG_TTL = int(os.getenv("CRM_TARIFF_CATALOG_TTL", 24 * 60 * 60))
+TARIFF_MISS_REFRESH_INTERVAL = 5 * 60  # Не перезагружать каталог из-за промаха чаще, чем раз в 5 минут
+
+# Каталог тарифов филиала: {"loaded_at": timestamp, "tariffs": {tariff_id: price}}
+# (v2 - формат с loaded_at, прежние записи без него не читаются)
+tariff_catalog_cache = TwoLevelCache("crm:tariff_catalog:v2", TARIFF_CATALOG_TTL)
+
+
+def load_tariff_catalog(branch_id) -> dict | None:
+    """
+    Загружает из CRM все тарифы филиала.
+    Ключи tariffs - строки, чтобы словарь одинаково выглядел в памяти и после чтения из Redis.
+    """
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/tariff/index"
+    try:
+        tariffs = {str(tariff.get("id")): tariff.get("price") for tariff in iter_crm_index(url)}
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить тарифы филиала {branch_id}: {e}")
+        return None
+
+    logger.info(f"Каталог тарифов филиала {branch_id} загружен: {len(tariffs)} тарифов")
+    return {"loaded_at": time(), "tariffs": tariffs}
+
+
+def refresh_tariff_catalog(branch_id) -> dict | None:
+    return tariff_catalog_cache.rebuild(branch_id, lambda: load_tariff_catalog(branch_id))
+
+
 def get_tariff_price(branch_id, tariff_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/tariff/index"
-    page = 0
-    data = {"page": 0}
-    tariff_objects = send_request_to_crm(url, data, None)
-    tariff_objects_items = tariff_objects.get("items")
-    last_page = 1
-    if tariff_objects.get("count") != 0:
-        last_page = tariff_objects.get("total") // tariff_objects.get("count")
-    while page <= last_page:
-        for tariff in tariff_objects_items:
-            if tariff.get("id") == tariff_id:
-                return tariff.get("price")
-        page += 1
-        data = {"page": page}
-        tariff_objects_items = send_request_to_crm(url, data, None).get("items")
-    return 0
+    catalog = tariff_catalog_cache.get_or_rebuild(branch_id, lambda: load_tariff_catalog(branch_id))
+    if not catalog:
+        return 0
+
+    price = catalog["tariffs"].get(str(tariff_id))
+    if price is None and time() - catalog["loaded_at"] > TARIFF_MISS_REFRESH_INTERVAL:
+        # Тариф мог появиться после последней загрузки каталога
+        catalog = refresh_tariff_catalog(branch_id)
+        if catalog:
+            price = catalog["tariffs"].get(str(tariff_id))
+    return price if price is not None else 0
+
+
+DISCOUNT_INTERVALS_TTL = int(os.getenv("CRM_DISCOUNT_INTERVALS_TTL", 10 * 60))
+
+# Скидки клиента: [[begin, end, amount], ...], даты - порядковые номера дней (date.toordinal)
+discount_intervals_cache = TwoLevelCache("crm:discount_intervals", DISCOUNT_INTERVALS_TTL)
+
+
+def load_discount_intervals(branch_id, user_crm_id) -> list | None:
+    """
+    Загружает все скидки клиента и возвращает интервалы, отсортированные по дате начала.
+    Даты разбираются один раз при загрузке.
+    """
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/discount/index"
+    intervals = []
+    try:
+        for discount in iter_crm_index(url, {"customer_id": user_crm_id}):
+            try:
+                begin = datetime.strptime(discount.get("begin"), "%d.%m.%Y").date()
+                end = datetime.strptime(discount.get("end"), "%d.%m.%Y").date()
+            except (ValueError, TypeError):
+                logger.warning(f"Некорректные даты скидки клиента {user_crm_id}: {discount}")
+                continue
+            intervals.append([begin.toordinal(), end.toordinal(), discount.get("amount")])
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить скидки клиента {user_crm_id}: {e}")
+        return None
+
+    intervals.sort()
+    return intervals
+
+
+def get_discount_intervals(branch_id, user_crm_id) -> list:
+    return discount_intervals_cache.get_or_set(
+        f"{branch_id}:{user_crm_id}",
+        lambda: load_discount_intervals(branch_id, user_crm_id),
+    ) or []
 
 
 def get_curr_discount(branch_id, user_crm_id, curr_date):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/discount/index"
-    page = 0
-    data = {"customer_id": user_crm_id, "page": 0}
-    discounts = send_request_to_crm(url, data, None)
-    discounts_items = discounts.get("items")
-    last_page = 1
-    if discounts.get("count") != 0:
-        last_page = discounts.get("total") // discounts.get("count")
-    while page < last_page:
-        for discount in sorted(
-            discounts_items, key=lambda x: datetime.strptime(x.get("end"), "%d.%m.%Y")
-        ):
-            discount_end_date = datetime.strptime(discount.get("end"), "%d.%m.%Y")
-            discount_begin_date = datetime.strptime(discount.get("begin"), "%d.%m.%Y")
-            if discount_end_date.date() >= curr_date >= discount_begin_date.date():
-                return discount.get("amount")
-        page += 1
-        data.update({"page": page})
-        discounts = send_request_to_crm(url, data, None)
-        discounts_items = discounts.get("items")
-    return 0
+    intervals = get_discount_intervals(branch_id, user_crm_id)
+    day = curr_date.toordinal()
+
+    # Интервалы, начавшиеся не позже curr_date
+    started = bisect_right(intervals, day, key=lambda interval: interval[0])
+    active = [interval for interval in intervals[:started] if interval[1] >= day]
+    if not active:
+        return 0
+    # Как и раньше, при пересечении берем скидку, которая закончится раньше
+    return min(active, key=lambda interval: interval[1])[2]
 
 
 def get_client_lesson_name(
     branch_id: int, subject_id: int | None = None
 ) -> dict | None:
     data = {"id": subject_id, "active": True, "page": 0}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/subject/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/subject/index"
     response_data = send_request_to_crm(
         url,
         data,
@@ -368,12 +823,53 @@ def get_client_lesson_name(
     return {"total": 0}
 
 
+SUBJECT_CATALOG_TTL = int(os.getenv("CRM_SUBJECT_CATALOG_TTL", 24 * 60 * 60))
+
+# Справочник предметов (курсов) филиала: {subject_id: name}
+subject_catalog_cache = TwoLevelCache("crm:subject_catalog", SUBJECT_CATALOG_TTL)
+
+
+def load_subject_catalog(branch_id) -> dict | None:
+    """
+    Загружает из CRM все активные предметы филиала и возвращает словарь {subject_id: name}.
+    """
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/subject/index"
+    try:
+        catalog = {str(subject.get("id")): subject.get("name", "") for subject in iter_crm_index(url, {"active": True})}
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить предметы филиала {branch_id}: {e}")
+        return None
+
+    logger.info(f"Справочник предметов филиала {branch_id} загружен: {len(catalog)} предметов")
+    return catalog
+
+
+def refresh_subject_catalog(branch_id) -> dict | None:
+    return subject_catalog_cache.rebuild(branch_id, lambda: load_subject_catalog(branch_id))
+
+
+def get_subject_name(branch_id, subject_id) -> str:
+    """
+    Возвращает название предмета по ID из кэшированного справочника филиала.
+    Если предмета нет в справочнике, запрашивает его из CRM напрямую.
+    """
+    catalog = subject_catalog_cache.get_or_rebuild(branch_id, lambda: load_subject_catalog(branch_id)) or {}
+    if str(subject_id) in catalog:
+        return catalog[str(subject_id)]
+
+    lesson_info = get_client_lesson_name(branch_id, subject_id)
+    for item in lesson_info.get("items", []):
+        if item.get("id") == subject_id:
+            return item.get("name", "")
+    return ""
+
+
 def get_user_groups_from_crm(branch_id: int, user_crm_id: int) -> dict | None:
     data = {"page": 0}
     params = {
         "customer_id": user_crm_id,
     }
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/cgi/customer"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/cgi/customer"
 
     logger.debug("Попытка получить группы пользователя (ID)")
     response_data = send_request_to_crm(url=url, data=data, params=params)
@@ -384,7 +880,7 @@ def get_user_groups_from_crm(branch_id: int, user_crm_id: int) -> dict | None:
 
 def get_group_link_from_crm(branch_id: int, group_id: int) -> dict | None:
     data = {"id": group_id, "page": 0}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/group/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/group/index"
 
     response_data = send_request_to_crm(url=url, data=data, params=None)
     if response_data:
@@ -404,7 +900,7 @@ def find_client_by_id(branch_id, crm_id):
         "page": 0
     }
     
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/customer/index"
     
     try:
         response = send_request_to_crm(url=url, data=data, params=None)
@@ -433,7 +929,7 @@ def find_client_by_id(branch_id, crm_id):
 
 def get_manager_from_crm(branch_id, page=0):
     data = {"page": page}
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/user/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/user/index"
     try:
         response: dict = send_request_to_crm(url=url, data=data, params=None)
         if response:
@@ -449,7 +945,7 @@ def get_manager_from_crm(branch_id, page=0):
 
 def set_client_kiberons(branch_id, customer_id, kiberons_from_kiberclub):
     try:
-        url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/bonus/bonus-add?customer_id={customer_id}"
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/bonus/bonus-add?customer_id={customer_id}"
         data = {
             "amount": kiberons_from_kiberclub 
         }
@@ -467,7 +963,7 @@ def set_client_kiberons(branch_id, customer_id, kiberons_from_kiberclub):
 
 
 def get_client_kiberons(branch_id, customer_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/bonus/balance-bonus?customer_id={customer_id}"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/bonus/balance-bonus?customer_id={customer_id}"
     
     response: dict = send_request_to_crm(url=url, data=None, params=None)
     if response:
@@ -482,42 +978,79 @@ def get_client_kiberons(branch_id, customer_id):
 
 
 def get_all_clients(branch_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/customer/index"
-    
-    page = 0
-    count = 1
-    
-    while count > 0:
-        data = {
-            "is_study": 0,
-            "page": page
-        }
-        clients_response = send_request_to_crm(url=url, data=data, params=None)
-        
-        if not clients_response:
-            logger.error(f"Не удалось получить клиентов для филиала {branch_id}, страница {page}")
-            break
-            
-        if "items" in clients_response:
-            clients = clients_response["items"]
-            count = clients_response.get("count", 0)
-            logger.info(f"Получено {len(clients)} клиентов для филиала {branch_id}, страница {page}")
-            
-            # Возвращаем клиентов по одному через yield
-            for client in clients:
-                yield client
-                
-        else:
-            logger.error(f"Неверный формат ответа от CRM для филиала {branch_id}, страница {page}")
-            break
-            
-        page += 1
-    
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/customer/index"
+
+    try:
+        # Возвращаем клиентов по одному через yield
+        yield from iter_crm_index(url, {"is_study": 0})
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить клиентов для филиала {branch_id}: {e}")
+
     logger.info(f"Завершено получение клиентов для филиала {branch_id}")
 
 
+def get_branch_customers(branch_id) -> dict | None:
+    """
+    Загружает всех клиентов и лидов филиала постранично и возвращает словарь {crm_id: клиент}.
+    Если хотя бы одну страницу получить не удалось, возвращает None:
+    по неполному списку нельзя судить, что клиента в CRM нет.
+    """
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/customer/index"
+    try:
+        customers = {str(customer.get("id")): customer for customer in iter_crm_index(url, {"is_study": 2})}
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить клиентов филиала {branch_id}: {e}")
+        return None
+
+    logger.info(f"Получено клиентов филиала {branch_id}: {len(customers)}")
+    return customers
+
+
+MANAGER_DIRECTORY_TTL = int(os.getenv("CRM_MANAGER_DIRECTORY_TTL", 6 * 60 * 60))
+MANAGER_MISS_REFRESH_INTERVAL = 5 * 60  # Не пересобирать справочник из-за промаха чаще, чем раз в 5 минут
+
+# Справочник сотрудников филиала: {"loaded_at": timestamp, "managers": {user_id: manager}}
+manager_directory_cache = TwoLevelCache("crm:manager_directory", MANAGER_DIRECTORY_TTL)
+
+
+def load_manager_directory(branch_id) -> dict | None:
+    """
+    Загружает из CRM всех сотрудников филиала (/user/index).
+    """
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/user/index"
+    try:
+        managers = {str(manager.get("id")): manager for manager in iter_crm_index(url)}
+    except CrmPageError as e:
+        logger.error(f"Не удалось получить менеджеров филиала {branch_id}: {e}")
+        return None
+
+    logger.info(f"Справочник менеджеров филиала {branch_id} загружен: {len(managers)} сотрудников")
+    return {"loaded_at": time(), "managers": managers}
+
+
+def refresh_manager_directory(branch_id) -> dict | None:
+    return manager_directory_cache.rebuild(branch_id, lambda: load_manager_directory(branch_id))
+
+
+def get_manager_by_id(branch_id, manager_id) -> dict | None:
+    """
+    Возвращает сотрудника CRM по ID из кэшированного справочника филиала.
+    """
+    directory = manager_directory_cache.get_or_rebuild(branch_id, lambda: load_manager_directory(branch_id))
+    if not directory:
+        return None
+
+    manager = directory["managers"].get(str(manager_id))
+    if manager is None and time() - directory["loaded_at"] > MANAGER_MISS_REFRESH_INTERVAL:
+        # Сотрудник мог появиться после последней загрузки справочника
+        directory = refresh_manager_directory(branch_id)
+        if directory:
+            manager = directory["managers"].get(str(manager_id))
+    return manager
+
+
 def get_taught_trial_lesson(customer_id, branch_id):
-    url = f"https://{CRM_HOSTNAME}/v2api/{branch_id}/lesson/index"
+    url = f"{CRM_BASE_URL}/v2api/{branch_id}/lesson/index"
 
     data = {
         "customer_id": customer_id,
@@ -0,0 +1,464 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+from typing import Awaitable, Callable
+
+import httpx
+
+from app_api.alfa_crm_service.crm_service import (
+    BASE_HEADERS,
+    CRM_BASE_URL,
+    REQUEST_TIMEOUT,
+    get_crm_token,
+    get_lesson_count_key,
+    invalidate_crm_token,
+    lesson_count_cache,
+    lesson_counters,
+)
+from app_api.alfa_crm_service.crm_rate_limiter import crm_rate_limiter, parse_retry_after
+from app_api.alfa_crm_service.crm_resilience import crm_circuit_breaker, crm_retry_policy, is_idempotent
+from app_api.alfa_crm_service.crm_response_cache import crm_response_cache
+from app_api.alfa_crm_service.crm_single_flight import make_request_key
+from app_api.utils.util_cache import TwoLevelCache
+
+logger = logging.getLogger(__name__)
+
+# Максимальное количество одновременных запросов к CRM в рамках одного веера
+ASYNC_REQUEST_LIMIT = int(os.getenv("CRM_ASYNC_REQUEST_LIMIT", 8))
+# Пул keep-alive соединений общего асинхронного клиента на один процесс (на все веера процесса)
+CRM_ASYNC_POOL_MAXSIZE = int(os.getenv("CRM_ASYNC_POOL_MAXSIZE", 20))
+
+GROUP_NOTE_TTL = int(os.getenv("CRM_GROUP_NOTE_TTL", 60 * 60))
+
+# Примечания групп (ссылки на Telegram-чаты): ключ "{branch_id}:{group_id}"
+group_note_cache = TwoLevelCache("crm:group_note", GROUP_NOTE_TTL)
+
+
+_event_loop: asyncio.AbstractEventLoop | None = None
+_event_loop_pid: int | None = None
+_event_loop_lock = threading.Lock()
+_http_client: httpx.AsyncClient | None = None
+
+
+def _reset_event_loop():
+    """
+    Сбрасывает event loop и HTTP-клиент в дочернем процессе после fork:
+    поток цикла в дочерний процесс не переходит, а сокеты родителя использовать нельзя.
+    """
+    global _event_loop, _event_loop_pid, _event_loop_lock, _http_client
+    _event_loop = None
+    _event_loop_pid = None
+    _event_loop_lock = threading.Lock()
+    _http_client = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_event_loop)
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Возвращает общий для процесса event loop, работающий в фоновом потоке.
+    httpx.AsyncClient привязан к циклу, в котором открыты его соединения,
+    поэтому все веера запросов процесса выполняются в одном цикле.
+    """
+    global _event_loop, _event_loop_pid, _http_client
+    pid = os.getpid()
+    if _event_loop is None or _event_loop_pid != pid:
+        with _event_loop_lock:
+            if _event_loop is None or _event_loop_pid != pid:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="crm-async-loop", daemon=True).start()
+                _event_loop = loop
+                _event_loop_pid = pid
+                _http_client = None
+                logger.info(f"Запущен event loop CRM для процесса {pid}")
+    return _event_loop
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Возвращает общий для процесса асинхронный HTTP-клиент CRM.
+    Клиент держит пул keep-alive соединений, поэтому TCP+TLS рукопожатие
+    не повторяется в каждом веере. Использовать только в цикле get_event_loop().
+    """
+    global _http_client
+    loop = get_event_loop()
+    if _http_client is None:
+        with _event_loop_lock:
+            if _http_client is None and _event_loop is loop:
+                _http_client = httpx.AsyncClient(
+                    headers=BASE_HEADERS,
+                    timeout=REQUEST_TIMEOUT,
+                    limits=httpx.Limits(
+                        max_connections=CRM_ASYNC_POOL_MAXSIZE,
+                        max_keepalive_connections=CRM_ASYNC_POOL_MAXSIZE,
+                    ),
+                )
+    return _http_client
+
+
+class AsyncCrmClient:
+    """
+    Асинхронный клиент CRM.
+    Все запросы внутри одного контекста идут через общий пул соединений
+    и общий семафор, ограничивающий количество одновременных запросов.
+
+    http_client - общий HTTP-клиент (см. get_async_http_client); без него клиент
+    создается на время контекста и закрывается при выходе.
+
+    Использование:
+        async with AsyncCrmClient() as crm:
+            results = await crm.gather([crm.find_client_by_id(1, 10), ...])
+    """
+
+    def __init__(self, limit: int = ASYNC_REQUEST_LIMIT, http_client: httpx.AsyncClient | None = None):
+        self.limit = limit
+        self._http: httpx.AsyncClient | None = http_client
+        self._owns_http = http_client is None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._token: str | None = None
+        # Выполняющиеся чтения: одинаковые запросы внутри веера ждут одну задачу
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def __aenter__(self) -> "AsyncCrmClient":
+        if self._owns_http:
+            self._http = httpx.AsyncClient(
+                headers=BASE_HEADERS,
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=self.limit,
+                    max_keepalive_connections=self.limit,
+                ),
+            )
+        self._semaphore = asyncio.Semaphore(self.limit)
+        # Токен берется один раз на весь веер запросов
+        self._token = await asyncio.to_thread(get_crm_token)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._owns_http:
+            await self._http.aclose()
+            self._http = None
+
+    async def gather(self, coroutines: list[Awaitable]) -> list:
+        """
+        Выполняет корутины конкурентно и возвращает результаты в исходном порядке.
+        Исключение в одной корутине не прерывает остальные: вместо результата будет None.
+        """
+        results = await asyncio.gather(*coroutines, return_exceptions=True)
+        answer = []
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка при выполнении запроса к CRM: {result}")
+                answer.append(None)
+            else:
+                answer.append(result)
+        return answer
+
+    async def send_request(self, url: str, data: dict | None, params: dict | None) -> dict | None:
+        if not is_idempotent(url):
+            response = await self._send_request(url, data, params)
+            await asyncio.to_thread(crm_response_cache.invalidate, url, data, params)
+            return response
+
+        # Обращения к Redis синхронные - выполняются в потоке, чтобы не блокировать цикл
+        cached = await asyncio.to_thread(crm_response_cache.get, url, data, params)
+        if cached is not None:
+            return cached
+
+        key = make_request_key(url, data, params)
+        task = self._inflight.get(key)
+        if task is not None:
+            return copy.deepcopy(await asyncio.shield(task))
+
+        task = asyncio.ensure_future(self._fetch_and_cache(url, data, params))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_and_cache(self, url: str, data: dict | None, params: dict | None) -> dict | None:
+        response = await self._send_request(url, data, params)
+        if response is not None:
+            await asyncio.to_thread(crm_response_cache.set, url, data, params, response)
+        return response
+
+    async def _send_request(self, url: str, data: dict | None, params: dict | None) -> dict | None:
+        if not self._token:
+            logger.error("Токен отсутствует. Отмена запроса.")
+            return None
+
+        idempotent = is_idempotent(url)
+        token_refreshed = False
+
+        for attempt in range(crm_retry_policy.max_retries):
+            is_last_attempt = attempt + 1 == crm_retry_policy.max_retries
+            if not await asyncio.to_thread(crm_circuit_breaker.allow_request):
+                logger.error(f"CRM временно недоступна, запрос отклонен без отправки. URL: {url}")
+                return None
+
+            try:
+                async with self._semaphore:
+                    if not await crm_rate_limiter.acquire_async(url):
+                        return None
+                    response = await self._http.post(
+                        url, headers={"X-ALFACRM-TOKEN": self._token}, json=data, params=params
+                    )
+            except httpx.HTTPError as e:
+                await asyncio.to_thread(crm_circuit_breaker.record_failure)
+                # ConnectError/ConnectTimeout - запрос точно не дошел до CRM
+                connect_failed = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not is_last_attempt and crm_retry_policy.should_retry_error(connect_failed, idempotent):
+                    delay = crm_retry_policy.get_delay(attempt)
+                    logger.warning(f"Ошибка при отправке запроса: {e}. Повторная попытка через {delay:.1f} секунд...")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"Ошибка при отправке запроса: {e}")
+                return None
+
+            if response.status_code >= 500:
+                await asyncio.to_thread(crm_circuit_breaker.record_failure)
+
+            if response.status_code == 200:
+                try:
+                    return response.json()
+                except json.JSONDecodeError:
+                    logger.error("Ошибка декодирования JSON. Ответ: %s", response.text)
+                    return None
+            elif response.status_code == 401:
+                if token_refreshed:
+                    logger.error("Неавторизованный запрос. Отмена запроса.")
+                    return None
+                # Токен общий для всего веера: его обновит первый получивший 401
+                logger.warning("Неавторизованный запрос. Обновляем токен и повторяем запрос...")
+                rejected_token = self._token
+                await asyncio.to_thread(invalidate_crm_token, rejected_token)
+                if self._token == rejected_token:
+                    self._token = await asyncio.to_thread(get_crm_token)
+                if not self._token:
+                    logger.error("Токен отсутствует. Отмена запроса.")
+                    return None
+                token_refreshed = True
+                continue
+            elif response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                pause = retry_after if retry_after is not None else crm_retry_policy.get_delay(attempt)
+                logger.warning(
+                    f"Слишком много запросов. Повторная попытка через {pause:.1f} секунд..."
+                )
+                if not await asyncio.to_thread(crm_rate_limiter.report_throttled, pause):
+                    # Без Redis общая пауза не действует - ждем в этом процессе
+                    await asyncio.sleep(pause)
+                continue
+            elif not is_last_attempt and crm_retry_policy.should_retry_status(response.status_code, idempotent):
+                delay = crm_retry_policy.get_delay(attempt)
+                logger.warning(f"Статус {response.status_code}. Повторная попытка через {delay:.1f} секунд...")
+                await asyncio.sleep(delay)
+                continue
+            else:
+                logger.error(f"Неожиданный статус: {response.status_code}. Тело: {response.text}")
+                return None
+
+        logger.error("Достигнуто максимальное количество попыток. Запрос не выполнен.")
+        return None
+
+    async def get_client_lessons(
+        self,
+        user_crm_id: int,
+        branch_id: int,
+        page: int | None = None,
+        lesson_status: int = 1,
+        lesson_type: int = 2,
+    ) -> dict:
+        data = {
+            "customer_id": user_crm_id,
+            "status": lesson_status,  # 1 - запланирован урок, 2 - отменен, 3 - проведен
+            "lesson_type_id": lesson_type,  # 3 - пробный, 2 - групповой
+            "page": 0 if page is None else page,
+        }
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/lesson/index"
+
+        response_data = await self.send_request(url, data, params=None)
+        if isinstance(response_data, dict) and "total" in response_data:
+            return response_data
+        logger.warning(f"Не удалось получить данные уроков: {response_data}")
+        return {"total": 0}
+
+    async def get_lesson_counters(self, user_crm_id: int, branch_id: int, lesson_status: int = 1, lesson_type: int = 2) -> dict | None:
+        data = {
+            "customer_id": user_crm_id,
+            "status": lesson_status,
+            "lesson_type_id": lesson_type,
+            "page": 0,
+        }
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/lesson/index"
+
+        counters = lesson_counters(await self.send_request(url, data, params=None))
+        if counters is None:
+            logger.warning(f"Не удалось получить число уроков клиента {user_crm_id}")
+        return counters
+
+    async def get_customer(self, branch_id, crm_id) -> dict | None:
+        """
+        Клиент из CRM по ID. {} - клиент не найден, None - ошибка запроса.
+        """
+        data = {
+            "id": crm_id,
+            "is_study": 2,  # 1 - клиенты, 0 - лиды, 2 - все
+            "page": 0,
+        }
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/customer/index"
+
+        response = await self.send_request(url, data, params=None)
+        if not response:
+            logger.error("Пустой ответ от CRM")
+            return None
+
+        clients = response.get("items", [])
+        return clients[0] if clients else {}
+
+    async def find_client_by_id(self, branch_id, crm_id) -> dict | None:
+        customer = await self.get_customer(branch_id, crm_id)
+        if customer == {}:
+            logger.error(f"Клиент с ID {crm_id} не найден")
+            return None
+        return customer
+
+    async def get_client_lesson_name(self, branch_id: int, subject_id: int | None = None) -> dict:
+        data = {"id": subject_id, "active": True, "page": 0}
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/subject/index"
+
+        response_data = await self.send_request(url, data, params=None)
+        if response_data and response_data.get("total") != 0:
+            return response_data
+        return {"total": 0}
+
+    async def get_user_groups_from_crm(self, branch_id: int, user_crm_id: int) -> dict | None:
+        """
+        Группы клиента из CRM. {"total": 0} - клиент не состоит в группах, None - ошибка запроса.
+        """
+        data = {"page": 0}
+        params = {"customer_id": user_crm_id}
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/cgi/customer"
+
+        response_data = await self.send_request(url, data, params=params)
+        if response_data is None:
+            return None
+        if response_data.get("total", 0) != 0:
+            return response_data
+        return {"total": 0}
+
+    async def get_group_link_from_crm(self, branch_id: int, group_id: int) -> dict | None:
+        """
+        Группа из CRM. {"total": 0} - группа не найдена, None - ошибка запроса.
+        """
+        data = {"id": group_id, "page": 0}
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/group/index"
+
+        response_data = await self.send_request(url, data, params=None)
+        if response_data is None:
+            return None
+        if response_data.get("total") != 0:
+            return response_data
+        return {"total": 0}
+
+    async def get_client_kiberons(self, branch_id, customer_id):
+        url = f"{CRM_BASE_URL}/v2api/{branch_id}/bonus/balance-bonus?customer_id={customer_id}"
+
+        response = await self.send_request(url, None, params=None)
+        if response:
+            return response.get("balance_bonus", 0)
+        logger.error(f"Запрос для получения числа киберонов не успешный: {response}")
+        return None
+
+
+def run_concurrently(
+    build_requests: Callable[[AsyncCrmClient], list[Awaitable]],
+    limit: int = ASYNC_REQUEST_LIMIT,
+) -> list:
+    """
+    Синхронная точка входа для views и задач Celery.
+    Открывает AsyncCrmClient на общем HTTP-клиенте процесса, выполняет собранные запросы
+    конкурентно (не более limit одновременно) в общем event loop и возвращает результаты
+    в исходном порядке.
+
+    Пример:
+        results = run_concurrently(
+            lambda crm: [crm.find_client_by_id(branch_id, crm_id) for crm_id in crm_ids]
+        )
+    """
+
+    loop = get_event_loop()
+    crm = AsyncCrmClient(limit=limit, http_client=get_async_http_client())
+    # Корутины собираются вне event loop: аргументы вычисляются синхронно,
+    # поэтому обращения к ORM внутри build_requests безопасны
+    coroutines = build_requests(crm)
+    if not coroutines:
+        return []
+
+    async def runner():
+        async with crm:
+            return await crm.gather(coroutines)
+
+    # Соединения общего клиента живут в цикле фонового потока: asyncio.run создавал бы
+    # новый цикл и новый клиент на каждый вызов
+    return asyncio.run_coroutine_threadsafe(runner(), loop).result()
+
+
+def get_group_notes(branch_id, group_ids) -> dict:
+    """
+    Возвращает примечания (ссылки на чаты) групп филиала: {group_id: note}.
+    Найденные в кэше группы берутся из него, остальные запрашиваются из CRM
+    конкурентно и кэшируются. Группы, которые не удалось получить, в ответ не попадают.
+    """
+    group_ids = list(dict.fromkeys(group_ids))
+    cached = group_note_cache.get_many([f"{branch_id}:{group_id}" for group_id in group_ids])
+    notes = {}
+    misses = []
+    for group_id in group_ids:
+        key = f"{branch_id}:{group_id}"
+        if key in cached:
+            notes[group_id] = cached[key]
+        else:
+            misses.append(group_id)
+
+    if not misses:
+        return notes
+
+    logger.info(f"Группы филиала {branch_id}: из кэша {len(notes)}, из CRM {len(misses)}")
+    responses = run_concurrently(lambda crm: [crm.get_group_link_from_crm(branch_id, group_id) for group_id in misses])
+
+    fetched = {}
+    for group_id, group_link_data in zip(misses, responses):
+        # Ошибку CRM не кэшируем как пустое примечание - группа будет запрошена снова
+        if group_link_data is None:
+            continue
+        items = group_link_data.get("items", [])
+        # Пустая строка тоже кэшируется, чтобы не запрашивать группы без ссылки повторно
+        fetched[group_id] = (items[0].get("note") or "") if items else ""
+
+    group_note_cache.set_many({f"{branch_id}:{group_id}": note for group_id, note in fetched.items()})
+    notes.update(fetched)
+    return notes
+
+
+def get_lesson_counts(lessons: list[tuple]) -> list[int | None]:
+    """
+    Число уроков для списка (customer_id, branch_id, status, lesson_type) в исходном порядке.
+    Счетчики берутся из кэша, недостающие запрашиваются из CRM конкурентно и кэшируются.
+    Для запросов, завершившихся ошибкой, возвращается None.
+    """
+    keys = [get_lesson_count_key(*lesson) for lesson in lessons]
+    counters = lesson_count_cache.get_many(keys)
+    misses = [(key, lesson) for key, lesson in zip(keys, lessons) if key not in counters]
+
+    if misses:
+        responses = run_concurrently(lambda crm: [crm.get_lesson_counters(*lesson) for _, lesson in misses])
+        fetched = {key: response for (key, _), response in zip(misses, responses) if response is not None}
+        lesson_count_cache.set_many(fetched)
+        counters.update(fetched)
+
+    return [counters[key]["total"] if key in counters else None for key in keys]
@@ -0,0 +1,104 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+from time import monotonic, sleep
+from typing import Any, Callable
+
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Объединять одинаковые запросы не только внутри процесса, но и между процессами (через Redis)
+SINGLE_FLIGHT_DISTRIBUTED = os.getenv("CRM_SINGLE_FLIGHT_DISTRIBUTED") == "True"
+SINGLE_FLIGHT_RESULT_TTL = 2  # Сколько хранить результат для ожидающих процессов, секунды
+SINGLE_FLIGHT_WAIT_TIMEOUT = 15  # Сколько ждать результат чужого запроса, секунды
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+
+def make_request_key(url: str, data: dict | None, params: dict | None) -> str:
+    """
+    Ключ запроса: URL и канонический JSON данных и параметров.
+    """
+    canonical = json.dumps([url, data, params], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные запросы: пока запрос с ключом key выполняется,
+    остальные вызовы с тем же ключом ждут его результат, а не идут в CRM сами.
+    Это не кэш: результат не сохраняется после завершения запроса.
+    Ожидающие получают копию результата, чтобы изменения у одного вызывающего не влияли на других.
+    """
+
+    def __init__(self, distributed: bool = SINGLE_FLIGHT_DISTRIBUTED):
+        self.distributed = distributed
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Call] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.event.wait()
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = self._do_distributed(key, fn) if self.distributed else fn()
+            return call.result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _do_distributed(self, key: str, fn: Callable[[], Any]) -> Any:
+        lock_key = f"crm:single_flight:{key}:lock"
+        result_key = f"crm:single_flight:{key}:result"
+        try:
+            redis_client = get_redis_client()
+            is_leader = redis_client.set(lock_key, 1, nx=True, ex=SINGLE_FLIGHT_WAIT_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Объединение запросов через Redis недоступно: {e}")
+            return fn()
+
+        if is_leader:
+            try:
+                result = fn()
+                if result is not None:
+                    redis_client.set(result_key, json.dumps(result, ensure_ascii=False), ex=SINGLE_FLIGHT_RESULT_TTL)
+                return result
+            finally:
+                redis_client.delete(lock_key)
+
+        # Такой же запрос выполняет другой процесс - ждем его результат
+        deadline = monotonic() + SINGLE_FLIGHT_WAIT_TIMEOUT
+        while monotonic() < deadline:
+            raw = redis_client.get(result_key)
+            if raw is not None:
+                return json.loads(raw)
+            if not redis_client.exists(lock_key):
+                # Лидер мог записать результат между двумя проверками
+                raw = redis_client.get(result_key)
+                if raw is not None:
+                    return json.loads(raw)
+                # Лидер завершился без результата - выполняем запрос сами
+                break
+            sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        return fn()
+
+
+crm_single_flight = SingleFlight()
@@ -0,0 +1,162 @@
+import logging
+import os
+from datetime import datetime
+
+from app_api.alfa_crm_service.crm_service import fetch_client_lessons, find_client_by_id, get_manager_by_id
+from app_api.alfa_crm_service.crm_service_async import get_group_notes, run_concurrently
+from app_api.utils.util_cache import StaleWhileRevalidateCache
+from app_kiberclub.models import AppUser
+
+logger = logging.getLogger(__name__)
+
+# Данные эндпоинтов бота, которые отдаются из кэша в режиме stale-while-revalidate:
+# после fresh_ttl значение еще grace секунд отдается сразу, а обновляется в фоне задачей Celery
+VIEW_CACHE_LOCAL_TTL = 10
+
+user_lessons_cache = StaleWhileRevalidateCache(
+    "crm:view:user_lessons",
+    fresh_ttl=int(os.getenv("CRM_VIEW_LESSONS_FRESH_TTL", 60)),
+    grace=int(os.getenv("CRM_VIEW_LESSONS_GRACE", 6 * 60 * 60)),
+    local_ttl=VIEW_CACHE_LOCAL_TTL,
+)
+client_manager_cache = StaleWhileRevalidateCache(
+    "crm:view:client_manager",
+    fresh_ttl=int(os.getenv("CRM_VIEW_MANAGER_FRESH_TTL", 10 * 60)),
+    grace=int(os.getenv("CRM_VIEW_MANAGER_GRACE", 24 * 60 * 60)),
+    local_ttl=VIEW_CACHE_LOCAL_TTL,
+)
+user_tg_links_cache = StaleWhileRevalidateCache(
+    "crm:view:user_tg_links",
+    fresh_ttl=int(os.getenv("CRM_VIEW_TG_LINKS_FRESH_TTL", 10 * 60)),
+    grace=int(os.getenv("CRM_VIEW_TG_LINKS_GRACE", 24 * 60 * 60)),
+    local_ttl=VIEW_CACHE_LOCAL_TTL,
+)
+
+
+def load_user_lessons(user_crm_id, branch_id, lesson_status, lesson_type) -> dict | None:
+    return fetch_client_lessons(user_crm_id, branch_id, lesson_status=lesson_status, lesson_type=lesson_type)
+
+
+def load_client_manager(branch_id, user_crm_id) -> dict | None:
+    """
+    Клиент и его назначенный менеджер: {"assigned_id", "is_study", "manager"}.
+    None, если клиент не найден.
+    """
+    client = find_client_by_id(branch_id, user_crm_id)
+    if not client:
+        return None
+
+    assigned_id = client.get("assigned_id")
+    return {
+        "assigned_id": assigned_id,
+        "is_study": client.get("is_study", False),
+        "manager": get_manager_by_id(branch_id, assigned_id) if assigned_id else None,
+    }
+
+
+def load_user_tg_links(telegram_id) -> list | None:
+    """
+    Ссылки на Telegram-чаты актуальных групп всех клиентов пользователя.
+    None, если CRM не ответила хотя бы на один запрос групп: неполный список ссылок
+    не должен заменять в кэше последний полученный.
+    """
+    user = AppUser.objects.filter(telegram_id=telegram_id).first()
+    if not user:
+        return None
+
+    # Клиенты с заполненными branch_id и crm_id
+    crm_clients = [client for client in user.clients.all().select_related("branch") if client.branch_id and client.crm_id]
+
+    # 1. Группы всех клиентов запрашиваем из CRM конкурентно
+    groups_responses: list = run_concurrently(
+        lambda crm: [crm.get_user_groups_from_crm(client.branch.branch_id, client.crm_id) for client in crm_clients]
+    )
+    failed_clients = [client.crm_id for client, response in zip(crm_clients, groups_responses) if response is None]
+    if failed_clients:
+        logger.warning(f"Не удалось получить группы клиентов {failed_clients} пользователя {telegram_id}")
+        return None
+
+    current_date = datetime.now().date()
+
+    # Уникальные пары (филиал, группа) в порядке появления
+    group_keys: list = []
+    for client, user_groups_data in zip(crm_clients, groups_responses):
+        if not user_groups_data or user_groups_data.get("total", 0) == 0:
+            continue
+
+        for group_item in user_groups_data["items"]:
+            # Проверяем актуальность участия ученика в группе по дате окончания обучения
+            e_date_str = group_item.get("e_date")
+            if e_date_str:
+                try:
+                    e_date = datetime.strptime(e_date_str, "%d.%m.%Y").date()
+                    # Если дата окончания обучения уже прошла, пропускаем эту группу
+                    if e_date < current_date:
+                        continue
+                except (ValueError, TypeError):
+                    # Если не удалось преобразовать дату, считаем группу актуальной
+                    pass
+
+            group_id = group_item.get("group_id")
+            if not group_id:
+                continue
+
+            group_key = (client.branch.branch_id, group_id)
+            if group_key not in group_keys:
+                group_keys.append(group_key)
+
+    # 2. Ссылки на группы: из кэша, недостающие - из CRM конкурентно
+    group_notes: dict = {}
+    for branch_id in dict.fromkeys(branch_id for branch_id, _ in group_keys):
+        branch_group_ids = [group_id for key_branch_id, group_id in group_keys if key_branch_id == branch_id]
+        for group_id, note in get_group_notes(branch_id, branch_group_ids).items():
+            group_notes[(branch_id, group_id)] = note
+
+    group_tg_links: list = []
+    for group_key in group_keys:
+        group_tg_link = group_notes.get(group_key)
+        if group_tg_link and group_tg_link not in group_tg_links:
+            group_tg_links.append(group_tg_link)
+    return group_tg_links
+
+
+# Имя кэша -> (кэш, загрузчик). Аргументы загрузчика образуют ключ кэша
+VIEW_CACHES = {
+    "user_lessons": (user_lessons_cache, load_user_lessons),
+    "client_manager": (client_manager_cache, load_client_manager),
+    "user_tg_links": (user_tg_links_cache, load_user_tg_links),
+}
+
+
+def _get_cached(name: str, *args):
+    # Задача лежит в app_api.tasks (там ее регистрирует воркер) и сама импортирует этот модуль
+    from app_api.tasks.crm_view_cache import refresh_view_cache
+
+    cache, loader = VIEW_CACHES[name]
+    key = ":".join(str(arg) for arg in args)
+    return cache.get_or_revalidate(
+        key,
+        lambda: loader(*args),
+        lambda: refresh_view_cache.delay(name, list(args)),
+    )
+
+
+def refresh_cached_view(name: str, args: list):
+    """
+    Обновляет значение кэша эндпоинта бота. None, если загрузить данные не удалось.
+    """
+    cache, loader = VIEW_CACHES[name]
+    key = ":".join(str(arg) for arg in args)
+    return cache.refresh(key, lambda: loader(*args))
+
+
+def get_cached_user_lessons(user_crm_id, branch_id, lesson_status=1, lesson_type=2) -> dict | None:
+    return _get_cached("user_lessons", user_crm_id, branch_id, lesson_status, lesson_type)
+
+
+def get_cached_client_manager(branch_id, user_crm_id) -> dict | None:
+    return _get_cached("client_manager", branch_id, user_crm_id)
+
+
+def get_cached_user_tg_links(telegram_id) -> list | None:
+    return _get_cached("user_tg_links", telegram_id)
@@ -0,0 +1,484 @@
+"""
+Локальный тестовый сервер AlfaCRM для нагрузочных тестов и замеров без настоящей CRM.
+
+Отдает эндпоинты v2api, которые использует crm_service: авторизацию, */index, cgi/customer,
+бонусы и создание/изменение клиентов. Данные генерируются детерминированно (по seed)
+или загружаются из JSON-фикстур; ответы можно записывать с настоящей CRM и воспроизводить.
+Поддерживаются задержки по распределению, ответы 429 и 500 с заданной вероятностью.
+
+Запуск: python manage.py run_fake_crm --port 8765
+Настройка клиента: CRM_HOSTNAME=127.0.0.1:8765, CRM_SCHEME=http
+
+Служебные эндпоинты:
+    GET  /__stats - счетчики запросов по эндпоинтам
+    POST /__reset - обнуление счетчиков
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = (
+    "customer",
+    "lesson",
+    "tariff",
+    "customer-tariff",
+    "discount",
+    "cgi",
+    "group",
+    "user",
+    "subject",
+)
+
+
+class FakeCrmConfig:
+    """
+    Настройки тестового сервера.
+
+    latency - распределение задержки ответа, секунды:
+        "0.05" или "const:0.05", "uniform:0.02:0.2", "normal:0.1:0.03", "lognormal:-2.5:0.5"
+    throttle_rate - доля запросов, на которые отвечаем 429 с заголовком Retry-After
+    error_rate - доля запросов, на которые отвечаем 500
+    """
+
+    def __init__(
+        self,
+        page_size: int = 50,
+        latency: str = "0",
+        throttle_rate: float = 0.0,
+        retry_after: float = 1,
+        error_rate: float = 0.0,
+        seed: int = 42,
+        branches: tuple = (1,),
+        customers_per_branch: int = 200,
+        fixtures: str | None = None,
+        cassette: str | None = None,
+        record_upstream: str | None = None,
+    ):
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.seed = seed
+        self.branches = branches
+        self.customers_per_branch = customers_per_branch
+        self.fixtures = fixtures
+        self.cassette = cassette
+        self.record_upstream = record_upstream
+
+
+def make_latency_sampler(spec: str, rng: random.Random) -> Callable[[], float]:
+    kind, _, args = spec.partition(":") if ":" in spec else ("const", "", spec)
+    values = [float(value) for value in args.split(":") if value]
+    if kind == "const":
+        return lambda: values[0] if values else 0
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def _format_date(day: date) -> str:
+    return day.strftime("%d.%m.%Y")
+
+
+def generate_branch_data(branch_id: int, customers_count: int, rng: random.Random) -> dict:
+    """
+    Синтетические данные филиала в формате ответов AlfaCRM: {сущность: [элементы]}.
+    """
+    today = date.today()
+    id_base = branch_id * 100000
+
+    users = [
+        {"id": id_base + i, "name": f"Менеджер {i}", "phone": [f"+37529{branch_id:02d}{i:05d}"], "email": f"manager{i}@example.com"}
+        for i in range(1, 11)
+    ]
+    subjects = [{"id": id_base + i, "name": f"Курс {i}", "active": True} for i in range(1, 6)]
+    tariffs = [{"id": id_base + i, "name": f"Тариф {i}", "price": 100 + 20 * i} for i in range(1, 6)]
+    groups = [
+        {"id": id_base + i, "name": f"Группа {i}", "note": f"https://t.me/+fake_group_{branch_id}_{i}"}
+        for i in range(1, customers_count // 10 + 2)
+    ]
+
+    customers, lessons, customer_tariffs, discounts, cgi = [], [], [], [], []
+    lesson_id = id_base
+    for i in range(1, customers_count + 1):
+        customer_id = id_base + i
+        is_study = int(rng.random() < 0.7)
+        next_lesson = today + timedelta(days=rng.randint(0, 7)) if is_study else None
+        customers.append(
+            {
+                "id": customer_id,
+                "branch_ids": [branch_id],
+                "name": f"Клиент {branch_id}-{i}",
+                "is_study": is_study,
+                "legal_type": 1,
+                "phone": [f"+37533{branch_id:02d}{i:05d}"],
+                "dob": _format_date(date(2012 + i % 8, 1 + i % 12, 1 + i % 28)),
+                "balance": str(rng.choice([-50, 0, 0, 30, 120])),
+                "paid_lesson_count": rng.randint(-2, 8),
+                "paid_till": _format_date(today + timedelta(days=rng.randint(-10, 30))),
+                "next_lesson_date": f"{next_lesson.isoformat()} 15:00:00" if next_lesson else None,
+                "assigned_id": rng.choice(users)["id"],
+                "note": "",
+                "balance_bonus": rng.randint(0, 200),
+            }
+        )
+
+        group = rng.choice(groups)
+        cgi.append(
+            {
+                "id": customer_id,
+                "group_id": group["id"],
+                "customer_id": customer_id,
+                "b_date": _format_date(today - timedelta(days=120)),
+                "e_date": _format_date(today + timedelta(days=rng.randint(-30, 240))),
+            }
+        )
+        customer_tariffs.append(
+            {
+                "id": customer_id,
+                "customer_id": customer_id,
+                "tariff_id": rng.choice(tariffs)["id"],
+                "b_date": _format_date(today - timedelta(days=60)),
+                "e_date": _format_date(today + timedelta(days=60)),
+            }
+        )
+        if rng.random() < 0.3:
+            discounts.append(
+                {
+                    "id": customer_id,
+                    "customer_id": customer_id,
+                    "begin": _format_date(today - timedelta(days=30)),
+                    "end": _format_date(today + timedelta(days=30)),
+                    "amount": rng.choice([5, 10, 15]),
+                }
+            )
+
+        # Прошедшие и запланированные групповые уроки, для части клиентов - пробный
+        for day_offset in range(-21, 15, 7):
+            lesson_id += 1
+            lesson_day = today + timedelta(days=day_offset + i % 7)
+            lessons.append(
+                _make_lesson(lesson_id, branch_id, customer_id, lesson_day, 2, group["id"], subjects[i % 5]["id"], rng)
+            )
+        if i % 5 == 0:
+            lesson_id += 1
+            lessons.append(
+                _make_lesson(lesson_id, branch_id, customer_id, today + timedelta(days=i % 3 - 1), 3, None, subjects[0]["id"], rng)
+            )
+
+    return {
+        "customer": customers,
+        "lesson": lessons,
+        "tariff": tariffs,
+        "customer-tariff": customer_tariffs,
+        "discount": discounts,
+        "cgi": cgi,
+        "group": groups,
+        "user": users,
+        "subject": subjects,
+    }
+
+
+def _make_lesson(lesson_id, branch_id, customer_id, lesson_day, lesson_type_id, group_id, subject_id, rng) -> dict:
+    is_past = lesson_day < date.today()
+    return {
+        "id": lesson_id,
+        "branch_id": branch_id,
+        "date": lesson_day.isoformat(),
+        "lesson_date": lesson_day.isoformat(),
+        "time_from": f"{lesson_day.isoformat()} 15:00:00",
+        "time_to": f"{lesson_day.isoformat()} 16:30:00",
+        "lesson_type_id": lesson_type_id,
+        "status": 3 if is_past else 1,  # 1 - запланирован, 3 - проведен
+        "subject_id": subject_id,
+        "room_id": branch_id,
+        "customer_ids": [customer_id],
+        "group_ids": [group_id] if group_id else [],
+        "details": [
+            {"customer_id": customer_id, "is_attend": int(is_past and rng.random() < 0.9), "reason_id": None}
+        ] if is_past else [],
+    }
+
+
+class FakeCrmState:
+    """
+    Данные филиалов, выданные токены, счетчики запросов и кассета записанных ответов.
+    """
+
+    def __init__(self, config: FakeCrmConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.sample_latency = make_latency_sampler(config.latency, self.rng)
+        self.lock = threading.Lock()
+        self.tokens: set[str] = set()
+        self.stats: Counter = Counter()
+
+        self.branches: dict[int, dict] = {
+            branch_id: generate_branch_data(branch_id, config.customers_per_branch, self.rng)
+            for branch_id in config.branches
+        }
+        if config.fixtures:
+            # Фикстуры: {"branch_id": {"customer": [...], ...}} заменяют сгенерированные сущности
+            with open(config.fixtures, encoding="utf-8") as f:
+                for branch_id, entities in json.load(f).items():
+                    self.branches.setdefault(int(branch_id), {entity: [] for entity in ENTITIES}).update(entities)
+
+        self.cassette: dict[str, dict] = {}
+        if config.cassette:
+            try:
+                with open(config.cassette, encoding="utf-8") as f:
+                    self.cassette = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def save_cassette(self):
+        if not self.config.cassette:
+            return
+        with self.lock:
+            with open(self.config.cassette, "w", encoding="utf-8") as f:
+                json.dump(self.cassette, f, ensure_ascii=False, indent=2)
+
+    def next_id(self, branch_id: int, entity: str) -> int:
+        items = self.branches[branch_id][entity]
+        return max((item["id"] for item in items), default=branch_id * 100000) + 1
+
+
+def _matches(item: dict, name: str, value) -> bool:
+    if name == "customer_id" and "customer_ids" in item:
+        return int(value) in item["customer_ids"]
+    if name == "phone":
+        digits = "".join(ch for ch in str(value) if ch.isdigit())
+        return any(digits and digits in "".join(ch for ch in phone if ch.isdigit()) for phone in item.get("phone", []))
+    if name == "is_study" and int(value) == 2:
+        return True  # 2 - все клиенты и лиды
+    if name not in item:
+        return True  # Неизвестные фильтры игнорируются, как в CRM
+    item_value = item[name]
+    if isinstance(value, bool) or isinstance(item_value, bool):
+        return bool(item_value) == bool(value)
+    return str(item_value) == str(value)
+
+
+def handle_index(state: FakeCrmState, branch_id: int, entity: str, filters: dict) -> dict:
+    items = state.branches.get(branch_id, {}).get(entity, [])
+    page = int(filters.pop("page", 0) or 0)
+    for name, value in filters.items():
+        if value is None or value == "":
+            continue
+        items = [item for item in items if _matches(item, name, value)]
+
+    page_size = state.config.page_size
+    return {
+        "total": len(items),
+        "count": page_size,
+        "page": page,
+        "items": items[page * page_size:(page + 1) * page_size],
+    }
+
+
+def handle_write(state: FakeCrmState, branch_id: int, entity: str, action: str, data: dict, query: dict) -> dict | None:
+    customers = state.branches.setdefault(branch_id, {name: [] for name in ENTITIES})["customer"]
+    with state.lock:
+        if entity == "customer" and action == "create":
+            phone = data.get("phone")
+            customer = {
+                "branch_ids": [branch_id],
+                "balance": "0",
+                "paid_lesson_count": 0,
+                "balance_bonus": 0,
+                "assigned_id": None,
+                **data,
+                "id": state.next_id(branch_id, "customer"),
+                "phone": phone if isinstance(phone, list) else [phone] if phone else [],
+            }
+            customers.append(customer)
+            return {"success": True, "model": customer}
+
+        customer_id = query.get("customer_id") or query.get("id") or data.get("id")
+        customer = next((item for item in customers if str(item["id"]) == str(customer_id)), None)
+        if customer is None:
+            return None
+        if entity == "customer" and action == "update":
+            customer.update({key: value for key, value in data.items() if key != "id"})
+            return {"success": True, "model": customer}
+        if entity == "bonus" and action == "bonus-add":
+            customer["balance_bonus"] = customer.get("balance_bonus", 0) + int(data.get("amount", 0))
+            return {"success": True, "balance_bonus": customer["balance_bonus"]}
+        if entity == "bonus" and action == "balance-bonus":
+            return {"balance_bonus": customer.get("balance_bonus", 0)}
+    return None
+
+
+def make_cassette_key(path: str, body: dict) -> str:
+    canonical = json.dumps([path, body], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class FakeCrmHandler(BaseHTTPRequestHandler):
+    state: FakeCrmState  # Задается в make_server
+    # HTTP/1.1 - keep-alive, как у CRM: иначе бенчмарк не покажет переиспользование соединений
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status_code: int, payload: dict | None, headers: dict | None = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length)) or {}
+        except json.JSONDecodeError:
+            return {}
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/__stats":
+            with self.state.lock:
+                stats = dict(self.state.stats)
+            self._send_json(200, {"total": stats.get("total", 0), "requests": stats})
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/__reset":
+            with self.state.lock:
+                self.state.stats.clear()
+            self._send_json(200, {"success": True})
+            return
+
+        body = self._read_body()
+        query = {name: values[0] for name, values in parse_qs(parsed.query).items()}
+        parts = [part for part in parsed.path.split("/") if part]
+        endpoint = "/".join(part for part in parts[1:] if not part.isdigit())
+        with self.state.lock:
+            self.state.stats["total"] += 1
+            self.state.stats[endpoint] += 1
+            throttled = self.state.rng.random() < self.state.config.throttle_rate
+            failed = not throttled and self.state.rng.random() < self.state.config.error_rate
+            latency = self.state.sample_latency()
+
+        if latency > 0:
+            sleep(latency)
+        if throttled:
+            self._count("throttled")
+            self._send_json(429, {"message": "Too many requests"}, {"Retry-After": str(self.state.config.retry_after)})
+            return
+        if failed:
+            self._count("errors")
+            self._send_json(500, {"message": "Internal server error"})
+            return
+
+        if parts[:3] == ["v2api", "auth", "login"]:
+            if self.state.config.record_upstream:
+                # При записи токен выдает настоящая CRM, но в кассету он не попадает
+                self._record(None, body)
+                return
+            token = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.tokens.add(token)
+            self._send_json(200, {"token": token})
+            return
+
+        # При записи токен выдан настоящей CRM - его проверяет она сама
+        if not self.state.config.record_upstream and self.headers.get("X-ALFACRM-TOKEN") not in self.state.tokens:
+            self._send_json(401, {"message": "Unauthorized"})
+            return
+
+        cassette_key = make_cassette_key(self.path, body)
+        if cassette_key in self.state.cassette:
+            recorded = self.state.cassette[cassette_key]
+            self._send_json(recorded["status"], recorded["body"])
+            return
+        if self.state.config.record_upstream:
+            self._record(cassette_key, body)
+            return
+
+        if len(parts) != 4 or parts[0] != "v2api" or not parts[1].isdigit():
+            self._send_json(404, {"message": "Not found"})
+            return
+        branch_id, entity, action = int(parts[1]), parts[2], parts[3]
+
+        if entity == "cgi" and action == "customer":
+            response = handle_index(self.state, branch_id, "cgi", {**body, **query})
+        elif action == "index" and entity in ENTITIES:
+            response = handle_index(self.state, branch_id, entity, {**body, **query})
+        else:
+            response = handle_write(self.state, branch_id, entity, action, body, query)
+
+        if response is None:
+            self._send_json(404, {"message": "Not found"})
+        else:
+            self._send_json(200, response)
+
+    def _count(self, name: str):
+        with self.state.lock:
+            self.state.stats[name] += 1
+
+    def _record(self, cassette_key: str | None, body: dict):
+        """
+        Проксирует запрос в настоящую CRM и сохраняет ответ в кассету.
+        """
+        upstream_request = Request(
+            f"{self.state.config.record_upstream.rstrip('/')}{self.path}",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json", "X-ALFACRM-TOKEN": self.headers.get("X-ALFACRM-TOKEN", "")},
+            method="POST",
+        )
+        try:
+            with urlopen(upstream_request, timeout=30) as upstream_response:
+                status_code, payload = upstream_response.status, json.loads(upstream_response.read() or b"null")
+        except Exception as e:
+            logger.error(f"Не удалось записать ответ CRM {self.path}: {e}")
+            self._send_json(502, {"message": str(e)})
+            return
+
+        if cassette_key is not None:
+            with self.state.lock:
+                self.state.cassette[cassette_key] = {"status": status_code, "body": payload}
+            self.state.save_cassette()
+        self._send_json(status_code, payload)
+
+
+def make_server(host: str, port: int, config: FakeCrmConfig) -> ThreadingHTTPServer:
+    handler = type("BoundFakeCrmHandler", (FakeCrmHandler,), {"state": FakeCrmState(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 0, config: FakeCrmConfig | None = None) -> ThreadingHTTPServer:
+    """
+    Запускает сервер в фоновом потоке (для бенчмарков). port=0 - любой свободный порт,
+    фактический адрес - server.server_address.
+    """
+    server = make_server(host, port, config or FakeCrmConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
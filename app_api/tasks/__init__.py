@@ -1 +1 @@
-from . import crm_sync, check_client_trial_lessons_and_notify
+from . import crm_sync, check_client_trial_lessons_and_notify, crm_catalogs, crm_view_cache
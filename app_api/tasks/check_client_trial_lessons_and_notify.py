@@ -4,7 +4,8 @@ from django.conf import settings
 from app_kiberclub.models import Client, AppUser, Location
 from django.utils import timezone
 import logging
-from app_api.alfa_crm_service.crm_service import get_taught_trial_lesson, get_client_lessons
+from app_api.alfa_crm_service.crm_paginator import get_last_page
+from app_api.alfa_crm_service.crm_service import get_client_lessons, get_lesson_count, get_lesson_counters, get_taught_trial_lesson
 from datetime import datetime, timedelta, date
 
 
@@ -76,24 +77,19 @@ def check_clients_lessons_before():
 
         # 2. НАПОМИНАНИЕ О ПЕРВОМ ЗАНЯТИИ
         try:
-            # Запланированные уроки
-            lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2)
+            # Запланированные уроки (только счетчики, без страницы уроков)
+            planned_lessons = get_lesson_counters(client.crm_id, client.branch_id, lesson_status=1, lesson_type=2) or {}
 
-            planned_lessons_count = lesson_response.get("total", 0)
+            planned_lessons_count = planned_lessons.get("total", 0)
 
             if planned_lessons_count > 0:
                 # Проведенные уроки
-                user_taught_lessons = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=3, lesson_type=2)
+                taught_lessons_count = get_lesson_count(client.crm_id, client.branch_id, lesson_status=3, lesson_type=2)
 
                 # Если нет посещенных уроков
-                taught_lessons_count = user_taught_lessons.get("total", 0)
-
                 if taught_lessons_count == 0:
                     # Забираем последний запланированный урок
-                    if lesson_response.get("total", 0) > lesson_response.get("count", 0):
-                        page = lesson_response.get("total", 0) // lesson_response.get("count", 1)
-                    else:
-                        page = 0
+                    page = get_last_page(planned_lessons.get("total", 0), planned_lessons.get("count", 0))
 
                     lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2, page=page)
 
@@ -215,7 +211,7 @@ def send_birthday_congratulations():
     logger.info("Запущена проверка дней рождения клиентов и отправка поздравлений...")
 
     # Получаем клиентов с днем рождения сегодня
-    clients = Client.objects.filter(dob__day=today.day, dob__month=today.month, dob__isnull=False).prefetch_related("users")
+    clients = Client.objects.filter(dob_month=today.month, dob_day=today.day, dob__isnull=False).prefetch_related("users")
 
     congratulation_count = 0
 
@@ -295,16 +291,13 @@ def check_clients_balance_and_notify():
 
         # Получаем информацию об уроках клиента
         try:
-            lesson_response = get_client_lessons(user_crm_id=client.crm_id, branch_id=client.branch_id, lesson_status=1, lesson_type=2)
-            planned_lessons_count = lesson_response.get("total", 0)
+            planned_lessons = get_lesson_counters(client.crm_id, client.branch_id, lesson_status=1, lesson_type=2) or {}
+            planned_lessons_count = planned_lessons.get("total", 0)
 
             # Если есть запланированные уроки, проверяем дату ближайшего
             if planned_lessons_count > 0:
                 # Определяем страницу для получения последнего урока
-                if lesson_response.get("total", 0) > lesson_response.get("count", 0):
-                    page = lesson_response.get("total", 0) // lesson_response.get("count", 1)
-                else:
-                    page = 0
+                page = get_last_page(planned_lessons.get("total", 0), planned_lessons.get("count", 0))
 
                 logger.info(f"page: {page}")
 
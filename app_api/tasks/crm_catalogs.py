@@ -0,0 +1,51 @@
+import logging
+
+from celery import shared_task
+
+from app_api.alfa_crm_service.crm_service import (
+    get_crm_branch_ids,
+    refresh_manager_directory,
+    refresh_subject_catalog,
+    refresh_tariff_catalog,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def refresh_tariff_catalogs():
+    """
+    Обновляет кэш каталога тарифов для всех филиалов.
+    """
+    for branch_id in get_crm_branch_ids():
+        catalog = refresh_tariff_catalog(branch_id)
+        if catalog is None:
+            logger.error(f"Не удалось обновить каталог тарифов филиала {branch_id}")
+        else:
+            logger.info(f"Каталог тарифов филиала {branch_id} обновлен: {len(catalog['tariffs'])} тарифов")
+
+
+@shared_task
+def refresh_manager_directories():
+    """
+    Обновляет кэш справочника менеджеров для всех филиалов.
+    """
+    for branch_id in get_crm_branch_ids():
+        directory = refresh_manager_directory(branch_id)
+        if directory is None:
+            logger.error(f"Не удалось обновить справочник менеджеров филиала {branch_id}")
+        else:
+            logger.info(f"Справочник менеджеров филиала {branch_id} обновлен: {len(directory['managers'])} сотрудников")
+
+
+@shared_task
+def refresh_subject_catalogs():
+    """
+    Обновляет кэш справочника предметов (курсов) для всех филиалов.
+    """
+    for branch_id in get_crm_branch_ids():
+        catalog = refresh_subject_catalog(branch_id)
+        if catalog is None:
+            logger.error(f"Не удалось обновить справочник предметов филиала {branch_id}")
+        else:
+            logger.info(f"Справочник предметов филиала {branch_id} обновлен: {len(catalog)} предметов")
@@ -1,63 +1,173 @@
 import logging
+import os
 
-from app_api.alfa_crm_service.crm_service import find_client_by_id
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from app_api.alfa_crm_service.crm_phone_index import PhoneIndexBuilder, phone_index
+from app_api.alfa_crm_service.crm_service import get_branch_customers, get_crm_branch_ids
 from app_api.utils.util_parse_date import parse_date
-from app_api.views import update_bot_user_status
+from app_api.utils.util_user_status import update_users_statuses
 from app_kiberclub.models import Client
 from celery import shared_task
 
 logger = logging.getLogger(__name__)
 
+# Сколько клиентов записывать одним bulk_update (и одной транзакцией)
+SYNC_BATCH_SIZE = int(os.getenv("CRM_SYNC_BATCH_SIZE", 200))
+
+# Поля клиента, которые синхронизируются из CRM: поле модели -> функция получения значения из ответа CRM
+SYNC_FIELDS = {
+    "name": lambda crm_data: crm_data.get("name"),
+    "is_study": lambda crm_data: bool(crm_data.get("is_study")),
+    "dob": lambda crm_data: parse_date(crm_data.get("dob")),
+    "balance": lambda crm_data: crm_data.get("balance"),
+    "next_lesson_date": lambda crm_data: parse_date(crm_data.get("next_lesson_date")),
+    "paid_till": lambda crm_data: parse_date(crm_data.get("paid_till")),
+    "note": lambda crm_data: crm_data.get("note"),
+    "paid_lesson_count": lambda crm_data: crm_data.get("paid_lesson_count"),
+}
+
+# Поля, от которых зависит статус пользователя бота
+STATUS_FIELDS = {"is_study", "has_scheduled_lessons"}
+
 
 @shared_task
 def sync_all_users_with_crm():
     """
     Синхронизирует всех клиентов из CRM и обновляет их данные в БД.
+    Клиенты филиала загружаются из CRM целиком постранично и сопоставляются с БД по crm_id,
+    поэтому число запросов к CRM зависит от числа страниц, а не от числа клиентов.
+    В БД записываются только изменившиеся клиенты и только изменившиеся поля.
     """
-    clients = Client.objects.select_related("branch").prefetch_related("users").exclude(crm_id__isnull=True).exclude(crm_id="")
+    clients = list(Client.objects.select_related("branch").prefetch_related("users").exclude(crm_id__isnull=True).exclude(crm_id=""))
 
+    clients_by_branch: dict = {}
     for client in clients:
-        # Получаем всех пользователей, связанных с клиентом
-        user_ids = list(client.users.values_list('id', flat=True))
-        logger.info(f"Синхронизация клиента {client.crm_id} (Пользователи: {user_ids})")
-        
-        try:
-            crm_response = find_client_by_id(branch_id=client.branch.branch_id, crm_id=client.crm_id)
-            logger.info(crm_response)
+        clients_by_branch.setdefault(client.branch.branch_id, []).append(client)
+
+    changed_clients: list = []
+    changed_fields: dict = {}  # client.id -> изменившиеся поля
+    missing_clients: list = []
+    for branch_id, branch_clients in clients_by_branch.items():
+        crm_customers = get_branch_customers(branch_id)
+        if crm_customers is None:
+            # Без полного списка клиентов филиала нельзя удалять отсутствующих - пропускаем филиал
+            logger.error(f"Синхронизация филиала {branch_id} пропущена: не удалось получить клиентов из CRM")
+            continue
 
+        for client in branch_clients:
+            crm_response = crm_customers.get(str(client.crm_id))
             if not crm_response:
                 logger.warning(f"Нет данных для клиента {client.crm_id} в CRM")
-                client.delete()
+                missing_clients.append(client)
                 continue
-            
-            update_client_from_crm(client, crm_response)
-            
-            # Обновляем статус для всех связанных пользователей
-            for user in client.users.all():
-                update_bot_user_status(user)
 
-        except Exception as e:
-            logger.exception(f"Ошибка при синхронизации клиента {client.crm_id}: {e}")
+            try:
+                fields = update_client_from_crm(client, crm_response)
+            except Exception as e:
+                logger.exception(f"Ошибка при синхронизации клиента {client.crm_id}: {e}")
+                continue
+            if fields:
+                changed_clients.append(client)
+                changed_fields[client.id] = fields
+
+    # Статус пересчитывается только у пользователей удаленных клиентов и клиентов со смененным статусом
+    affected_user_ids = {user.id for client in missing_clients for user in client.users.all()}
+    affected_user_ids.update(
+        user.id
+        for client in changed_clients
+        if STATUS_FIELDS & changed_fields[client.id]
+        for user in client.users.all()
+    )
+
+    if missing_clients:
+        with transaction.atomic():
+            Client.objects.filter(id__in=[client.id for client in missing_clients]).delete()
+        logger.info(f"Удалено клиентов, которых нет в CRM: {len(missing_clients)}")
+
+    save_changed_clients(changed_clients, changed_fields)
+    update_users_statuses(affected_user_ids)
+
+    logger.info(
+        f"Синхронизация завершена: клиентов {len(clients)}, изменено {len(changed_clients)}, "
+        f"удалено {len(missing_clients)}, статусов пересчитано {len(affected_user_ids)}"
+    )
+
+
+def normalize_field_value(field_name: str, value):
+    """
+    Приводит значение из CRM к типу поля модели, чтобы сравнивать его со значением из БД.
+    """
+    field = Client._meta.get_field(field_name)
+    value = field.to_python(value)
+    if settings.USE_TZ and field.get_internal_type() == "DateTimeField" and value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
 
 
-def update_client_from_crm(client: Client, crm_data: dict):
+def update_client_from_crm(client: Client, crm_data: dict) -> set:
     """
-    Обновляет данные клиента на основе данных из CRM.
+    Переносит данные клиента из CRM в объект модели, не сохраняя его.
+    Возвращает набор изменившихся полей (пустой, если клиент не изменился).
     """
-    try:
-        client.name = crm_data.get("name")
-        client.is_study = bool(crm_data.get("is_study"))
-        client.dob = parse_date(crm_data.get("dob"))
-        client.balance = crm_data.get("balance")
-        client.next_lesson_date = parse_date(crm_data.get("next_lesson_date"))
-        client.paid_till = parse_date(crm_data.get("paid_till"))
-        client.note = crm_data.get("note")
-        client.paid_lesson_count = crm_data.get("paid_lesson_count")
+    changed = set()
+    for field_name, get_value in SYNC_FIELDS.items():
+        value = normalize_field_value(field_name, get_value(crm_data))
+        if getattr(client, field_name) != value:
+            setattr(client, field_name, value)
+            changed.add(field_name)
 
-        client.save()
-        logger.info(f"Клиент {client.crm_id} успешно обновлен")
+    # dob_month/dob_day сверяются отдельно от dob, чтобы заполнить их и у клиентов, загруженных до их появления
+    dob_parts = (client.dob_month, client.dob_day)
+    client.set_dob_parts()
+    if (client.dob_month, client.dob_day) != dob_parts:
+        changed.update({"dob_month", "dob_day"})
+    return changed
 
 
+def save_changed_clients(clients: list, changed_fields: dict):
+    """
+    Сохраняет изменившихся клиентов пачками по SYNC_BATCH_SIZE через bulk_update,
+    каждая пачка - в своей транзакции. Обновляются только поля, изменившиеся в пачке.
+    """
+    for start in range(0, len(clients), SYNC_BATCH_SIZE):
+        batch = clients[start:start + SYNC_BATCH_SIZE]
+        fields = sorted(set().union(*(changed_fields[client.id] for client in batch)))
+        with transaction.atomic():
+            Client.objects.bulk_update(batch, fields)
+        logger.info(f"Сохранено клиентов: {start + len(batch)} из {len(clients)}")
+
+
+@shared_task
+def rebuild_phone_index():
+    """
+    Пересобирает локальный индекс телефонов (см. crm_phone_index):
+    обходит всех клиентов всех филиалов из таблицы Branch и добавляет связи
+    пользователей бота (AppUser.phone_number) с их клиентами из БД.
+    Записи филиалов, которые не удалось обойти, переносятся из текущего индекса,
+    но такие филиалы не отмечаются в записях как полностью просмотренные.
+    """
+    builder = PhoneIndexBuilder()
+    failed_branches = set()
+    for branch_id in get_crm_branch_ids():
+        crm_customers = get_branch_customers(branch_id)
+        if crm_customers is None:
+            logger.error(f"Индекс телефонов: филиал {branch_id} не обойден, используются прежние записи")
+            failed_branches.add(str(branch_id))
+            continue
+        builder.add_customers(branch_id, crm_customers.values())
+    phone_index.carry_over_branches(builder, failed_branches)
+
+    user_clients = (
+        Client.users.through.objects
+        .filter(appuser__phone_number__isnull=False, client__crm_id__isnull=False)
+        .exclude(appuser__phone_number="")
+        .values_list("appuser__phone_number", "client__branch__branch_id", "client__crm_id")
+    )
+    for phone_number, branch_id, crm_id in user_clients:
+        if branch_id:
+            builder.add(phone_number, branch_id, crm_id)
 
-    except Exception as e:
-        logger.exception(f"Не удалось обновить клиента {client.crm_id}: {e}")
+    phone_index.replace(builder)
@@ -0,0 +1,16 @@
+import logging
+
+from celery import shared_task
+
+from app_api.alfa_crm_service.crm_view_cache import refresh_cached_view
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def refresh_view_cache(name: str, args: list):
+    """
+    Фоновое обновление устаревшего значения кэша эндпоинта бота.
+    """
+    if refresh_cached_view(name, args) is None:
+        logger.warning(f"Не удалось обновить кэш {name} для {args}, остается прежнее значение")
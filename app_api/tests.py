@@ -1,3 +1,44 @@
 from django.test import TestCase
+from rest_framework.test import APIRequestFactory
 
-# Create your tests here.
+from app_api.views import create_or_update_clients_in_db_view
+from app_kiberclub.models import AppUser, Branch, Client
+
+
+class CreateOrUpdateClientsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        cls.new_branch = Branch.objects.create(branch_id="2", name="Филиал 2")
+        cls.user = AppUser.objects.create(telegram_id="1001", phone_number="+375291234567")
+
+    def post_crm_items(self, crm_items: list):
+        # Пустая next_lesson_date - запланированных уроков нет, запрос к CRM не нужен
+        request = APIRequestFactory().post(
+            "/", {"user_id": self.user.id, "crm_items": crm_items}, format="json"
+        )
+        return create_or_update_clients_in_db_view(request)
+
+    def test_client_moved_to_new_branch(self):
+        client = Client.objects.create(branch=self.branch, crm_id="100", name="Старое имя")
+        client.users.add(self.user)
+
+        response = self.post_crm_items(
+            [{"id": 100, "branch_ids": [2], "name": "Новое имя", "is_study": 1, "next_lesson_date": ""}]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["created"], response.data["updated"]), (0, 1))
+        moved = Client.objects.get(crm_id="100")
+        self.assertEqual((moved.id, moved.branch, moved.name), (client.id, self.new_branch, "Новое имя"))
+        self.assertEqual(list(self.user.clients.all()), [moved])
+
+    def test_stale_branch_row_removed_when_new_branch_row_exists(self):
+        Client.objects.create(branch=self.branch, crm_id="100")
+        current = Client.objects.create(branch=self.new_branch, crm_id="100")
+
+        response = self.post_crm_items([{"id": 100, "branch_ids": [2], "next_lesson_date": ""}])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Client.objects.get(crm_id="100").id, current.id)
+        self.assertEqual(list(self.user.clients.all()), [current])
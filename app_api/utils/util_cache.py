@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from time import monotonic, sleep, time
+from typing import Any, Callable
+
+from app_api.utils.util_redis import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+REBUILD_LOCK_TIMEOUT = int(os.getenv("CACHE_REBUILD_LOCK_TIMEOUT", 120))
+REBUILD_WAIT_TIMEOUT = int(os.getenv("CACHE_REBUILD_WAIT_TIMEOUT", 15))
+REBUILD_POLL_INTERVAL = 0.2
+REVALIDATE_LOCK_TIMEOUT = int(os.getenv("CACHE_REVALIDATE_LOCK_TIMEOUT", 60))
+
+# Все кэши процесса - чтобы можно было сбросить их L1 (clear_local_caches)
+_caches: "weakref.WeakSet[TwoLevelCache]" = weakref.WeakSet()
+
+
+def clear_local_caches():
+    """
+    Очищает L1 всех кэшей процесса. Значения в Redis не трогаются.
+    """
+    for cache in list(_caches):
+        cache.clear_local()
+
+
+class TwoLevelCache:
+    """
+    Двухуровневый кэш: L1 - словарь в памяти процесса, L2 - Redis.
+    Значения хранятся в Redis в JSON, поэтому ключи словарей после чтения - строки.
+    Срок жизни значения в L1 повторяет оставшийся TTL ключа в Redis,
+    но не превышает local_ttl, если он задан (так ограничивается устаревание L1
+    в других процессах после удаления ключа).
+    max_local_entries ограничивает размер L1: при переполнении вытесняются
+    давно не использованные значения (LRU).
+    """
+
+    def __init__(self, prefix: str, ttl: int, local_ttl: int | None = None, max_local_entries: int | None = None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.max_local_entries = max_local_entries
+        self._local: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._local_lock = threading.Lock()
+        _caches.add(self)
+
+    def _redis_key(self, key) -> str:
+        return f"{self.prefix}:{key}"
+
+    def _get_local(self, key, now: float) -> tuple[bool, Any]:
+        with self._local_lock:
+            local = self._local.get(str(key))
+            if local is None:
+                return False, None
+            if local[0] <= now:
+                del self._local[str(key)]
+                return False, None
+            self._local.move_to_end(str(key))
+            return True, local[1]
+
+    def _set_local(self, key, value: Any, ttl: int | None = None):
+        ttl = ttl if ttl and ttl > 0 else self.ttl
+        if self.local_ttl is not None:
+            ttl = min(ttl, self.local_ttl)
+        with self._local_lock:
+            self._local[str(key)] = (monotonic() + ttl, value)
+            self._local.move_to_end(str(key))
+            if self.max_local_entries is not None:
+                while len(self._local) > self.max_local_entries:
+                    self._local.popitem(last=False)
+
+    def _drop_local(self, key):
+        with self._local_lock:
+            self._local.pop(str(key), None)
+
+    def clear_local(self):
+        with self._local_lock:
+            self._local.clear()
+
+    def get(self, key) -> Any | None:
+        found, value = self._get_local(key, monotonic())
+        if found:
+            return value
+
+        try:
+            pipe = get_redis_client().pipeline()
+            pipe.get(self._redis_key(key))
+            pipe.ttl(self._redis_key(key))
+            raw, ttl = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен при чтении: {e}")
+            return None
+
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        self._set_local(key, value, ttl)
+        return value
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Возвращает найденные в кэше значения {key: value}; отсутствующие ключи пропускаются.
+        Промахи L1 читаются из Redis одним pipeline.
+        """
+        found = {}
+        missing = []
+        now = monotonic()
+        for key in keys:
+            is_found, value = self._get_local(key, now)
+            if is_found:
+                found[key] = value
+            else:
+                missing.append(key)
+
+        if not missing:
+            return found
+
+        try:
+            pipe = get_redis_client().pipeline()
+            for key in missing:
+                pipe.get(self._redis_key(key))
+            raw_values = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен при чтении: {e}")
+            return found
+
+        for key, raw in zip(missing, raw_values):
+            if raw is None:
+                continue
+            value = json.loads(raw)
+            self._set_local(key, value)
+            found[key] = value
+        return found
+
+    def set_many(self, values: dict):
+        try:
+            pipe = get_redis_client().pipeline()
+            for key, value in values.items():
+                self._set_local(key, value)
+                pipe.set(self._redis_key(key), json.dumps(value, ensure_ascii=False), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен при записи: {e}")
+
+    def set(self, key, value: Any):
+        self._set_local(key, value)
+        try:
+            get_redis_client().set(self._redis_key(key), json.dumps(value, ensure_ascii=False), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен при записи: {e}")
+
+    def delete(self, key):
+        self._drop_local(key)
+        try:
+            get_redis_client().delete(self._redis_key(key))
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен при удалении: {e}")
+
+    def get_or_set(self, key, loader: Callable[[], Any]) -> Any | None:
+        """
+        Возвращает значение из кэша, а при промахе загружает его через loader и сохраняет.
+        Пустой результат loader (None) не кэшируется.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def rebuild(self, key, loader: Callable[[], Any]) -> Any | None:
+        """
+        Пересобирает значение с защитой от одновременной пересборки (single-flight):
+        loader выполняет только процесс, захвативший блокировку в Redis,
+        остальные ждут, пока новое значение появится в кэше.
+        """
+        lock_name = f"{self._redis_key(key)}:lock"
+        try:
+            redis_client = get_redis_client()
+            lock = redis_client.lock(lock_name, timeout=REBUILD_LOCK_TIMEOUT)
+            acquired = lock.acquire(blocking=False)
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен для блокировки: {e}")
+            lock, acquired = None, True
+
+        if not acquired:
+            # Пересборку выполняет другой процесс - ждем освобождения блокировки
+            deadline = monotonic() + REBUILD_WAIT_TIMEOUT
+            while monotonic() < deadline:
+                sleep(REBUILD_POLL_INTERVAL)
+                if not redis_client.exists(lock_name):
+                    self._drop_local(key)
+                    value = self.get(key)
+                    if value is not None:
+                        return value
+                    break
+            logger.warning(f"Кэш {self.prefix}: не дождались пересборки {key}, загружаем сами")
+
+        try:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+            return value
+        finally:
+            if lock is not None and acquired:
+                try:
+                    lock.release()
+                except Exception:
+                    logger.warning(f"Кэш {self.prefix}: блокировка пересборки {key} истекла")
+
+    def get_or_rebuild(self, key, loader: Callable[[], Any]) -> Any | None:
+        """
+        Как get_or_set, но промах пересобирается в режиме single-flight.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        return self.rebuild(key, loader)
+
+
+class StaleWhileRevalidateCache(TwoLevelCache):
+    """
+    Кэш в режиме stale-while-revalidate.
+    Значение свежее fresh_ttl секунд; еще grace секунд после этого оно отдается как есть,
+    а обновление запускается в фоне через schedule_refresh (например, задачей Celery).
+    Фоновое обновление ключа запускается не чаще раза в REVALIDATE_LOCK_TIMEOUT секунд
+    на все процессы. После окончания grace значение загружается синхронно (single-flight).
+    В Redis хранится конверт {"value": ..., "fresh_until": timestamp}.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        fresh_ttl: int,
+        grace: int,
+        local_ttl: int | None = None,
+        max_local_entries: int | None = None,
+    ):
+        super().__init__(prefix, fresh_ttl + grace, local_ttl=local_ttl, max_local_entries=max_local_entries)
+        self.fresh_ttl = fresh_ttl
+        self.grace = grace
+
+    def _load_entry(self, loader: Callable[[], Any]) -> dict | None:
+        value = loader()
+        if value is None:
+            return None
+        return {"value": value, "fresh_until": time() + self.fresh_ttl}
+
+    def _schedule_refresh(self, key, schedule_refresh: Callable[[], Any]):
+        try:
+            if not get_redis_client().set(f"{self._redis_key(key)}:revalidate", 1, nx=True, ex=REVALIDATE_LOCK_TIMEOUT):
+                # Обновление уже запущено другим запросом
+                return
+        except Exception as e:
+            logger.warning(f"Кэш {self.prefix}: Redis недоступен, фоновое обновление {key} пропущено: {e}")
+            return
+
+        try:
+            schedule_refresh()
+        except Exception as e:
+            logger.error(f"Кэш {self.prefix}: не удалось запустить фоновое обновление {key}: {e}")
+
+    def refresh(self, key, loader: Callable[[], Any]) -> Any | None:
+        """
+        Загружает свежее значение и сохраняет его в кэш. Используется фоновым обновлением.
+        """
+        self._drop_local(key)
+        entry = self.rebuild(key, lambda: self._load_entry(loader))
+        return entry["value"] if entry else None
+
+    def get_or_revalidate(self, key, loader: Callable[[], Any], schedule_refresh: Callable[[], Any]) -> Any | None:
+        """
+        Возвращает свежее или устаревшее (в пределах grace) значение без обращения к loader.
+        Для устаревшего значения запускает фоновое обновление, при промахе загружает значение сразу.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            if time() >= entry["fresh_until"]:
+                self._schedule_refresh(key, schedule_refresh)
+            return entry["value"]
+
+        entry = self.rebuild(key, lambda: self._load_entry(loader))
+        return entry["value"] if entry else None
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_redis_pool: redis.ConnectionPool | None = None
+_redis_pool_pid: int | None = None
+_redis_pool_lock = threading.Lock()
+
+
+def _reset_redis_pool():
+    """
+    Сбрасывает пул соединений в дочернем процессе после fork,
+    чтобы воркеры Celery не делили сокеты с родительским процессом.
+    """
+    global _redis_pool, _redis_pool_pid, _redis_pool_lock
+    _redis_pool = None
+    _redis_pool_pid = None
+    _redis_pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_redis_pool)
+
+
+def get_redis_pool() -> redis.ConnectionPool:
+    """
+    Возвращает общий для процесса пул соединений Redis.
+    Адрес и размер пула берутся из settings.REDIS_URL и settings.REDIS_MAX_CONNECTIONS.
+    """
+    global _redis_pool, _redis_pool_pid
+    pid = os.getpid()
+    if _redis_pool is None or _redis_pool_pid != pid:
+        with _redis_pool_lock:
+            if _redis_pool is None or _redis_pool_pid != pid:
+                _redis_pool = redis.ConnectionPool.from_url(
+                    settings.REDIS_URL,
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    decode_responses=True,
+                )
+                _redis_pool_pid = pid
+                logger.info(f"Создан пул соединений Redis для процесса {pid}")
+    return _redis_pool
+
+
+def reset_redis_pool():
+    """
+    Закрывает соединения пула и сбрасывает его: следующий get_redis_client()
+    создаст пул по текущему settings.REDIS_URL (так benchmark_crm переключается на отдельную БД Redis).
+    """
+    global _redis_pool, _redis_pool_pid
+    with _redis_pool_lock:
+        if _redis_pool is not None and _redis_pool_pid == os.getpid():
+            _redis_pool.disconnect()
+        _redis_pool = None
+        _redis_pool_pid = None
+
+
+def get_redis_client() -> redis.StrictRedis:
+    """
+    Возвращает клиент Redis поверх общего пула соединений.
+    Клиент дешевый: соединения берутся из пула и возвращаются в него.
+    """
+    return redis.StrictRedis(connection_pool=get_redis_pool())
@@ -0,0 +1,58 @@
+import logging
+
+from django.db.models import Case, Exists, F, OuterRef, Value, When
+
+from app_kiberclub.models import AppUser, Client
+
+logger = logging.getLogger(__name__)
+
+# Сколько ID передавать в одном UPDATE ... WHERE id IN (...) (ограничение числа параметров SQLite)
+STATUS_UPDATE_BATCH_SIZE = 500
+
+
+def annotate_user_statuses(users):
+    """
+    Добавляет к выборке пользователей вычисленный по клиентам статус new_status:
+    "2" (Клиент) - есть клиент с is_study=True,
+    "1" (Lead с группой) - иначе есть клиент с has_scheduled_lessons=True,
+    "0" (Lead) - во всех остальных случаях.
+    """
+    return users.annotate(
+        has_study_clients=Exists(Client.objects.filter(users=OuterRef("pk"), is_study=True)),
+        has_scheduled_clients=Exists(Client.objects.filter(users=OuterRef("pk"), has_scheduled_lessons=True)),
+    ).annotate(
+        new_status=Case(
+            When(has_study_clients=True, then=Value("2")),
+            When(has_scheduled_clients=True, then=Value("1")),
+            default=Value("0"),
+        )
+    )
+
+
+def update_users_statuses(user_ids=None) -> dict:
+    """
+    Пересчитывает статусы пользователей бота (всех, если user_ids=None).
+    Новые статусы вычисляются одним запросом, затем выполняется по одному UPDATE
+    на каждое значение статуса - только для пользователей, у которых статус изменился.
+    Возвращает изменения {user_id: новый статус}.
+    """
+    users = AppUser.objects.all()
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        users = users.filter(id__in=user_ids)
+
+    changes = dict(
+        annotate_user_statuses(users).exclude(status=F("new_status")).values_list("id", "new_status")
+    )
+
+    ids_by_status: dict = {}
+    for user_id, new_status in changes.items():
+        ids_by_status.setdefault(new_status, []).append(user_id)
+    for new_status, ids in ids_by_status.items():
+        for start in range(0, len(ids), STATUS_UPDATE_BATCH_SIZE):
+            AppUser.objects.filter(id__in=ids[start:start + STATUS_UPDATE_BATCH_SIZE]).update(status=new_status)
+
+    logger.info(f"Статусы пересчитаны: изменено {len(changes)} пользователей")
+    return changes
@@ -1,4 +1,5 @@
-from django.db.models import QuerySet
+from django.db import transaction
+from django.db.models import Count
 from django.shortcuts import render
 import logging
 
@@ -6,21 +7,42 @@ from rest_framework.decorators import api_view
 from app_api.alfa_crm_service.crm_service import (
     find_user_by_phone,
     create_user_in_crm,
-    get_client_lessons,
-    get_user_groups_from_crm,
-    get_group_link_from_crm,
-    find_client_by_id,
-    get_manager_from_crm,
+    has_scheduled_lessons_from_customer,
+)
+from app_api.alfa_crm_service.crm_service_async import get_lesson_counts, run_concurrently
+from app_api.alfa_crm_service.crm_view_cache import (
+    get_cached_client_manager,
+    get_cached_user_lessons,
+    get_cached_user_tg_links,
 )
 from rest_framework import status
 from rest_framework.response import Response
 
 from app_api.utils.util_erip import set_pay
 from app_api.utils.util_parse_date import parse_date
+from app_api.utils.util_user_status import update_users_statuses
 from app_kiberclub.models import AppUser, Client, Branch, ClientBonus, EripPaymentHelp, Location, PartnerCategory, PartnerClientBonus, QuestionsAnswers, SalesManager, SocialLink
 
 logger = logging.getLogger(__name__)
 
+# Промежуточная таблица связи пользователей бота и клиентов (М:М)
+UserClientLink = Client.users.through
+
+# Поля клиента, которые обновляются при повторной загрузке из CRM
+CLIENT_UPSERT_FIELDS = [
+    "is_study",
+    "name",
+    "dob",
+    "balance",
+    "next_lesson_date",
+    "paid_till",
+    "note",
+    "paid_lesson_count",
+    "has_scheduled_lessons",
+    "dob_month",
+    "dob_day",
+]
+
 
 @api_view(["POST"])
 def find_user_by_phone_view(request) -> Response:
@@ -30,8 +52,13 @@ def find_user_by_phone_view(request) -> Response:
             {"success": False, "message": "Номер телефона обязателен"},
             status=status.HTTP_400_BAD_REQUEST,
         )
-    search_result = find_user_by_phone(phone_number)
-    if search_result.get("total", 0) > 0:
+    # first_match - боту нужно только знать, есть ли клиент в CRM
+    first_match = bool(request.data.get("first_match"))
+    search_result = find_user_by_phone(phone_number, first_match=first_match)
+    complete = search_result.get("complete", True)
+    # Неполный список клиентов отдается только в режиме first_match (с complete=False в ответе):
+    # иначе бот передаст его в create_or_update_clients_in_db_view и отвяжет клиентов медленного филиала
+    if search_result.get("total", 0) > 0 and (complete or first_match):
         return Response(
             {
                 "success": True,
@@ -40,6 +67,13 @@ def find_user_by_phone_view(request) -> Response:
             },
             status=status.HTTP_200_OK,
         )
+    elif not complete:
+        # Ответили не все филиалы: нельзя утверждать, что клиента нет (бот создаст дубль)
+        # и нельзя отдавать неполный список клиентов
+        return Response(
+            {"success": False, "message": "CRM не ответила вовремя, повторите попытку позже", "user": None},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
     else:
         return Response(
             {"success": False, "message": "Пользователь не найден в CRM", "user": None},
@@ -272,35 +306,32 @@ def create_or_update_clients_in_db_view(request) -> Response:
         # Если CRM вернул пустой список, удаляем всех клиентов пользователя
         if not crm_items:
             logger.info(f"CRM вернул пустой список клиентов для user_id={user_id}. Удаляем клиентов.")
-            
-            # Получаем всех клиентов пользователя
-            user_clients = user.clients.all()
-            clients_count = user_clients.count()
-            deleted_clients_count = 0
-            
+
+            # Клиенты пользователя с числом связанных пользователей - одним запросом
+            # (фильтр по user.clients перед annotate ограничил бы подсчет одной связью)
+            user_clients = list(
+                Client.objects.filter(id__in=user.clients.values("id"))
+                .annotate(users_count=Count("users"))
+                .values_list("id", "users_count")
+            )
+            clients_count = len(user_clients)
+
+            # Клиенты, не связанные с другими пользователями, удаляются полностью, у остальных удаляется только связь
+            client_ids_to_delete = [client_id for client_id, users_count in user_clients if users_count <= 1]
+            deleted_clients_count = len(client_ids_to_delete)
+
             if clients_count > 0:
-                for client in user_clients:
-                    # Проверяем, связан ли клиент с другими пользователями
-                    other_users_count = client.users.exclude(id=user.id).count()
-                    
-                    if other_users_count == 0:
-                        # Клиент не связан с другими пользователями - удаляем полностью
-                        client.delete()
-                        deleted_clients_count += 1
-                        logger.info(f"Удален клиент: {client.crm_id} (без других связей)")
-                    else:
-                        # Клиент связан с другими пользователями - удаляем только связь
-                        user.clients.remove(client)
-                        logger.info(f"Удалена связь с клиентом: {client.crm_id} (есть другие пользователи: {other_users_count})")
-                
+                with transaction.atomic():
+                    UserClientLink.objects.filter(appuser_id=user.id).delete()
+                    Client.objects.filter(id__in=client_ids_to_delete).delete()
                 logger.info(f"Удалено клиентов: {deleted_clients_count}, удалено связей: {clients_count - deleted_clients_count}")
             else:
                 logger.info(f"У пользователя {user_id} нет клиентов для удаления")
-            
+
             # Обновляем статус пользователя
             update_bot_user_status(user)
             logger.info(f"Статус пользователя обновлен: {user.status}")
-            
+
             return Response(
                 {
                     "success": True,
@@ -311,88 +342,102 @@ def create_or_update_clients_in_db_view(request) -> Response:
                 status=status.HTTP_200_OK,
             )
 
-        # Обрабатываем непустой список клиентов из CRM
-        crm_ids: set = {str(item["id"]) for item in crm_items}
-        logger.info(f"CRM IDs из запроса: {crm_ids}")
-
-        # Получаем текущих клиентов пользователя
-        existing_clients: QuerySet = user.clients.all()
-        existing_crm_ids: set = {client.crm_id for client in existing_clients if client.crm_id}
-        logger.info(f"Существующие CRM IDs: {existing_crm_ids}")
-
-        # Удаляем связи с клиентами, которых нет в новом ответе от CRM
-        crm_ids_to_remove: set = existing_crm_ids - crm_ids
-        removed_relations_count: int = 0
-
-        if crm_ids_to_remove:
-            logger.info(f"CRM IDs для удаления связей: {crm_ids_to_remove}")
-            clients_to_remove = Client.objects.filter(crm_id__in=crm_ids_to_remove)
-            for client in clients_to_remove:
-                user.clients.remove(client)
-                removed_relations_count += 1
-                logger.info(f"Удалена связь с клиентом: {client.crm_id}")
-            logger.info(f"Удалено связей с клиентами: {removed_relations_count}")
-
-        # Создание и обновление клиентов
-        created_count: int = 0
-        updated_count: int = 0
-
+        # 1. Филиалы всех клиентов - одним запросом
+        items_by_key: dict = {}
         for item in crm_items:
-            crm_id = str(item["id"])
-            logger.info(f"Обработка клиента crm_id={crm_id}")
-
             try:
-                branch = Branch.objects.get(branch_id=item["branch_ids"][0])
-                logger.info(f"Филиал найден: {branch}")
-            except Branch.DoesNotExist:
-                logger.error(f"Филиал с branch_id={item['branch_ids'][0]} не найден")
-                continue
-            except (IndexError, KeyError) as e:
-                logger.error(f"Некорректные данные branch_ids для клиента crm_id={crm_id}: {e}")
+                key = (str(item["branch_ids"][0]), str(item["id"]))
+            except (IndexError, KeyError, TypeError) as e:
+                logger.error(f"Некорректные данные branch_ids для клиента {item.get('id')}: {e}")
                 continue
+            items_by_key[key] = item
 
-            # Получаем информацию об уроках
-            lessons: dict = get_client_lessons(
-                user_crm_id=int(item["id"]),
-                branch_id=int(item["branch_ids"][0]),
-                lesson_status=1,
-                lesson_type=2,
-            )
-            has_scheduled_lessons: bool = bool(lessons and lessons.get("total", 0) > 0)
+        branches: dict = {
+            branch.branch_id: branch
+            for branch in Branch.objects.filter(branch_id__in={branch_id for branch_id, _ in items_by_key})
+        }
+        for branch_id, crm_id in list(items_by_key):
+            if branch_id not in branches:
+                logger.error(f"Филиал с branch_id={branch_id} не найден")
+                del items_by_key[(branch_id, crm_id)]
+
+        # 2. Наличие запланированных уроков: по next_lesson_date из карточки клиента,
+        # если по ней не определить - по числу уроков (из кэша или конкурентными запросами к CRM)
+        keys: list = list(items_by_key)
+        scheduled_flags: dict = {key: has_scheduled_lessons_from_customer(items_by_key[key]) for key in keys}
+        keys_to_count: list = [key for key in keys if scheduled_flags[key] is None]
+        lesson_counts: list = get_lesson_counts(
+            [(int(crm_id), int(branch_id), 1, 2) for branch_id, crm_id in keys_to_count]
+        )
+        for key, lesson_count in zip(keys_to_count, lesson_counts):
+            scheduled_flags[key] = bool(lesson_count and lesson_count > 0)
+
+        # 3. Создание и обновление всех клиентов одним upsert
+        clients_to_upsert: list = []
+        for branch_id, crm_id in keys:
+            item = items_by_key[(branch_id, crm_id)]
+            has_scheduled_lessons: bool = scheduled_flags[(branch_id, crm_id)]
             logger.info(f"Клиент crm_id={crm_id} has_scheduled_lessons={has_scheduled_lessons}")
+            client = Client(
+                branch=branches[branch_id],
+                crm_id=crm_id,
+                is_study=bool(item.get("is_study", False)),
+                name=item.get("name"),
+                dob=parse_date(item.get("dob")),
+                balance=item.get("balance"),
+                next_lesson_date=parse_date(item.get("next_lesson_date")),
+                paid_till=parse_date(item.get("paid_till")),
+                note=item.get("note"),
+                paid_lesson_count=item.get("paid_lesson_count"),
+                has_scheduled_lessons=has_scheduled_lessons,
+            )
+            client.set_dob_parts()
+            clients_to_upsert.append(client)
 
-            # Создаем или обновляем клиента
-            try:
-                client, created = Client.objects.update_or_create(
-                    crm_id=crm_id,
-                    defaults={
-                        "branch": branch,
-                        "is_study": bool(item.get("is_study", False)),
-                        "name": item.get("name"),
-                        "dob": parse_date(item.get("dob")),
-                        "balance": item.get("balance"),
-                        "next_lesson_date": parse_date(item.get("next_lesson_date")),
-                        "paid_till": parse_date(item.get("paid_till")),
-                        "note": item.get("note"),
-                        "paid_lesson_count": item.get("paid_lesson_count"),
-                        "has_scheduled_lessons": has_scheduled_lessons,
-                    },
-                )
-                logger.info(f"Клиент {'создан' if created else 'обновлен'}: {client}")
+        crm_ids: set = {crm_id for _, crm_id in keys}
 
-                # Добавляем связь многие-ко-многим, если ее еще нет
-                if not user.clients.filter(id=client.id).exists():
-                    user.clients.add(client)
-                    logger.info(f"Добавлена связь пользователь-клиент: {user.id} - {client.id}")
+        with transaction.atomic():
+            # Клиент мог сменить филиал в CRM: upsert по (branch, crm_id) оставил бы и прежнюю запись
+            move_clients_to_new_branches({crm_id: branches[branch_id] for branch_id, crm_id in keys})
 
-                if created:
-                    created_count += 1
-                else:
-                    updated_count += 1
+            existing_keys: set = set(
+                Client.objects.filter(crm_id__in=crm_ids).values_list("branch__branch_id", "crm_id")
+            )
+            created_count: int = len(set(keys) - existing_keys)
+            updated_count: int = len(keys) - created_count
+
+            Client.objects.bulk_create(
+                clients_to_upsert,
+                update_conflicts=True,
+                unique_fields=["branch", "crm_id"],
+                update_fields=CLIENT_UPSERT_FIELDS,
+            )
 
-            except Exception as e:
-                logger.error(f"Ошибка при создании/обновлении клиента crm_id={crm_id}: {e}")
-                continue
+            # 4. Связи пользователь-клиент: сравниваем с текущими и меняем одним insert и одним delete
+            client_ids: set = {
+                client_id
+                for client_id, branch_id, crm_id in Client.objects.filter(crm_id__in=crm_ids).values_list(
+                    "id", "branch__branch_id", "crm_id"
+                )
+                if (branch_id, crm_id) in items_by_key
+            }
+            linked_client_ids: set = set(
+                UserClientLink.objects.filter(appuser_id=user.id).values_list("client_id", flat=True)
+            )
+
+            client_ids_to_unlink: set = linked_client_ids - client_ids
+            removed_relations_count: int = len(client_ids_to_unlink)
+            if client_ids_to_unlink:
+                UserClientLink.objects.filter(appuser_id=user.id, client_id__in=client_ids_to_unlink).delete()
+                logger.info(f"Удалено связей с клиентами: {removed_relations_count}")
+
+            client_ids_to_link: set = client_ids - linked_client_ids
+            if client_ids_to_link:
+                UserClientLink.objects.bulk_create(
+                    [UserClientLink(appuser_id=user.id, client_id=client_id) for client_id in client_ids_to_link],
+                    ignore_conflicts=True,
+                )
+                logger.info(f"Добавлено связей пользователь-клиент: {len(client_ids_to_link)}")
 
         logger.info(f"Итоги: создано={created_count}, обновлено={updated_count}, удалено связей={removed_relations_count}")
 
@@ -419,6 +464,40 @@ def create_or_update_clients_in_db_view(request) -> Response:
         )
 
 
+def move_clients_to_new_branches(target_branches: dict) -> set:
+    """
+    Переносит клиентов, сменивших филиал в CRM, в новый филиал: target_branches = {crm_id: Branch}.
+    Записей клиента в других филиалах оставаться не должно - по crm_id клиент ищется без учета филиала
+    (get_object_or_404(Client, crm_id=...)). Если записи в новом филиале еще нет, одна из прежних
+    переносится (вместе с ее связями, корзиной и заказами), остальные удаляются.
+    Возвращает crm_id перенесенных клиентов.
+    """
+    rows_by_crm_id: dict = {}
+    for client_id, crm_id, branch_pk in Client.objects.filter(crm_id__in=target_branches).values_list(
+        "id", "crm_id", "branch_id"
+    ):
+        rows_by_crm_id.setdefault(crm_id, []).append((client_id, branch_pk))
+
+    moved_crm_ids: set = set()
+    client_ids_to_delete: list = []
+    for crm_id, rows in rows_by_crm_id.items():
+        target_branch = target_branches[crm_id]
+        stale_ids = [client_id for client_id, branch_pk in rows if branch_pk != target_branch.pk]
+        if not stale_ids:
+            continue
+        if len(stale_ids) == len(rows):
+            Client.objects.filter(id=stale_ids[0]).update(branch=target_branch)
+            moved_crm_ids.add(crm_id)
+            stale_ids = stale_ids[1:]
+        client_ids_to_delete.extend(stale_ids)
+
+    if client_ids_to_delete:
+        Client.objects.filter(id__in=client_ids_to_delete).delete()
+    if moved_crm_ids or client_ids_to_delete:
+        logger.info(f"Клиенты сменили филиал: перенесено {len(moved_crm_ids)}, удалено прежних записей {len(client_ids_to_delete)}")
+    return moved_crm_ids
+
+
 def update_bot_user_status(user):
     """
     Обновляет статус пользователя на основе статусов его клиентов.
@@ -430,21 +509,11 @@ def update_bot_user_status(user):
     2. Иначе, если у пользователя есть хотя бы один клиент с has_scheduled_lessons=True,
        устанавливаем статус пользователя в "1" (Lead с группой).
     3. Иначе, устанавливаем статус пользователя в "0" (Lead).
+    Статус вычисляется одним запросом и сохраняется, только если изменился (см. update_users_statuses).
     """
-    # Получаем всех клиентов пользователя через отношение М:М
-    clients = user.clients.all()
-
-    # Проверяем, есть ли хотя бы один клиент с is_study=True
-    has_active_clients = clients.filter(is_study=True).exists()
-
-    # Если нет активных клиентов, проверяем наличие запланированных уроков
-    if not has_active_clients:
-        has_scheduled_lessons = clients.filter(has_scheduled_lessons=True).exists()
-        user.status = "1" if has_scheduled_lessons else "0"
-    else:
-        user.status = "2"  # Клиент
-
-    user.save()
+    changes = update_users_statuses([user.id])
+    if user.id in changes:
+        user.status = changes[user.id]
     logger.info(f"Статус пользователя {user.id} обновлен: {user.status}")
 
 
@@ -746,7 +815,8 @@ def get_user_lessons_view(request) -> Response:
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        lessons_data = get_client_lessons(user_crm_id, branch_id, lesson_status=lesson_status, lesson_type=lesson_type)
+        # Из кэша: устаревшие в пределах grace данные отдаются сразу и обновляются в фоне
+        lessons_data = get_cached_user_lessons(user_crm_id, branch_id, lesson_status=lesson_status, lesson_type=lesson_type)
         if lessons_data and lessons_data.get("total", 0) > 0:
             return Response(
                 {"success": True, "data": lessons_data},
@@ -804,41 +874,27 @@ def get_location_by_id(request, location_id: int):
 @api_view(["GET"])
 def get_manager(request, branch_id, user_crm_id):
     """Получение менеджера"""
-    # 1. Находим клиента
-    client = find_client_by_id(branch_id, user_crm_id)
-    if not client:
+    # 1. Находим клиента и его менеджера (из кэша, устаревшие данные обновляются в фоне)
+    client_manager = get_cached_client_manager(branch_id, user_crm_id)
+    if not client_manager:
         return Response(
             {"success": False, "message": "Клиент не найден."},
             status=status.HTTP_404_NOT_FOUND,
         )
 
     # 2. Проверяем назначенного менеджера
-    client_assigned_id = client.get("assigned_id")
+    client_assigned_id = client_manager.get("assigned_id")
 
     if client_assigned_id:
-        # 3. Если есть назначенный менеджер - ищем его
-        MAX_PAGES = 20
-        curr_page = 0
-
-        while curr_page < MAX_PAGES:
-            managers = get_manager_from_crm(branch_id, page=curr_page)
-            if not managers:
-                break
-
-            managers_items = managers.get("items", [])
-            if not managers_items:
-                break
-
-            for manager in managers_items:
-                if manager.get("id") == client_assigned_id:
-                    return Response(
-                        {"success": True, "data": manager, "has_assigned": True, "is_study": client.get("is_study", False)},
-                        status=status.HTTP_200_OK,
-                    )
-
-            curr_page += 1
+        # 3. Если есть назначенный менеджер - он уже найден в справочнике филиала
+        manager = client_manager.get("manager")
+        if manager:
+            return Response(
+                {"success": True, "data": manager, "has_assigned": True, "is_study": client_manager.get("is_study", False)},
+                status=status.HTTP_200_OK,
+            )
 
-        # Если прошли все страницы и не нашли менеджера
+        # Если менеджера нет в справочнике филиала
         return Response(
             {"success": False, "message": "Менеджер с ID {} не найден.".format(client_assigned_id)},
             status=status.HTTP_200_OK,
@@ -1011,43 +1067,8 @@ def get_user_tg_links(request) -> Response:
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        group_tg_links: list = []
-        for client in clients:
-            # Добавим проверку на наличие branch_id и crm_id
-            if not client.branch_id or not client.crm_id:
-                continue
-
-            user_groups_data: dict = get_user_groups_from_crm(client.branch.branch_id, client.crm_id)
-
-            if user_groups_data.get("total", 0) > 0:
-                from datetime import datetime
-
-                current_date = datetime.now().date()
-
-                for group_item in user_groups_data["items"]:
-                    # Проверяем актуальность участия ученика в группе по дате окончания обучения
-                    e_date_str = group_item.get("e_date")
-                    if e_date_str:
-                        try:
-                            e_date = datetime.strptime(e_date_str, "%d.%m.%Y").date()
-                            # Если дата окончания обучения уже прошла, пропускаем эту группу
-                            if e_date < current_date:
-                                continue
-                        except (ValueError, TypeError):
-                            # Если не удалось преобразовать дату, считаем группу актуальной
-                            pass
-
-                    group_id = group_item.get("group_id")
-                    if not group_id:
-                        continue
-
-                    group_link_data = get_group_link_from_crm(client.branch.branch_id, group_id)
-                    if group_link_data.get("total", 0) > 0:
-                        items = group_link_data.get("items", [])
-                        if items:
-                            group_tg_link = items[0].get("note")
-                            if group_tg_link and group_tg_link not in group_tg_links:
-                                group_tg_links.append(group_tg_link)
+        # Ссылки из кэша: устаревшие в пределах grace отдаются сразу и обновляются в фоне
+        group_tg_links: list = get_cached_user_tg_links(user_id) or []
 
         return Response({"success": True, "data": group_tg_links}, status=status.HTTP_200_OK)
 
@@ -1136,9 +1157,13 @@ def find_client_by_id_view(request) -> Response:
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+        clients = list(clients)
+        crm_responses: list = run_concurrently(
+            lambda crm: [crm.find_client_by_id(client.branch_id, client.crm_id) for client in clients]
+        )
+
         results = []
-        for client in clients:
-            result = find_client_by_id(client.branch_id, client.crm_id)
+        for client, result in zip(clients, crm_responses):
             if result:
                 results.append({"client_crm_id": client.crm_id, "data": result})
             else:
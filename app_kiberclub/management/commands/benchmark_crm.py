@@ -0,0 +1,310 @@
+import json
+import os
+import statistics
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from urllib.parse import urlparse
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory
+
+from app_api import views
+from app_api.alfa_crm_service import crm_service, crm_service_async
+from app_api.alfa_crm_service.crm_rate_limiter import crm_rate_limiter
+from app_api.alfa_crm_service.crm_resilience import crm_circuit_breaker
+from app_api.alfa_crm_service.crm_response_cache import crm_response_cache
+from app_api.alfa_crm_service.fake_crm_server import FakeCrmConfig, start_in_thread
+from app_api.tasks import check_client_trial_lessons_and_notify, crm_sync
+from app_api.utils import util_erip
+from app_api.utils.util_cache import clear_local_caches
+from app_api.utils.util_redis import get_redis_client, reset_redis_pool
+from app_kiberclub.models import AppUser, Branch, Client
+from celery_app import app
+
+SCENARIOS = (
+    "get_client_payment_data",
+    "get_user_tg_links",
+    "find_client_by_id_view",
+    "create_or_update_clients_in_db_view",
+    "sync_all_users_with_crm",
+    "check_clients_lessons_before",
+)
+
+# БД Redis для замеров: кэши, токен, размыкатель и ограничитель тестовой CRM не должны попасть в рабочую БД
+BENCHMARK_REDIS_DB = int(os.getenv("BENCHMARK_REDIS_DB", 15))
+
+
+def get_benchmark_redis_url() -> str:
+    return urlparse(settings.REDIS_URL)._replace(path=f"/{BENCHMARK_REDIS_DB}").geturl()
+
+
+def percentile(samples: list, percent: int) -> float:
+    if not samples:
+        return 0.0
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+@contextmanager
+def patched(target, name, value):
+    original = getattr(target, name)
+    setattr(target, name, value)
+    try:
+        yield
+    finally:
+        setattr(target, name, original)
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет эндпоинты и задачи Celery, работающие с CRM, на локальной тестовой CRM '
+        'и временной БД с синтетическими данными. Результаты сохраняются в JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Пользователей бота в тестовой БД')
+        parser.add_argument('--clients-per-user', type=int, default=2, help='Клиентов (детей) у каждого пользователя')
+        parser.add_argument('--branches', type=int, nargs='+', default=[1], help='ID филиалов')
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+        parser.add_argument('--repeat', type=int, default=1, help='Сколько раз прогнать каждый сценарий')
+        parser.add_argument('--latency', default='uniform:0.02:0.08', help='Задержка ответа тестовой CRM')
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--throttle-rate', type=float, default=0.0)
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--rate-limit', type=float, help='Переопределить CRM_RATE_LIMIT (запросов в секунду)')
+        parser.add_argument('--no-response-cache', action='store_true', help='Отключить кэш ответов CRM')
+        parser.add_argument('--label', default='', help='Метка прогона, например "before" или "after"')
+        parser.add_argument('--output', help='Файл результатов (по умолчанию fixtures/benchmarks/<время>.json)')
+        parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+        parser.add_argument(
+            '--redis-url',
+            help='Отдельная БД Redis для замеров, очищается перед каждым сценарием '
+                 '(по умолчанию REDIS_URL с номером БД BENCHMARK_REDIS_DB)',
+        )
+
+    def handle(self, *args, **options):
+        options['redis_url'] = options['redis_url'] or get_benchmark_redis_url()
+        if options['redis_url'] == settings.REDIS_URL:
+            raise CommandError('Замеры нельзя выполнять в рабочей БД Redis: укажите другую в --redis-url')
+
+        customers_per_branch = -(-options['users'] * options['clients_per_user'] // len(options['branches']))
+        config = FakeCrmConfig(
+            page_size=options['page_size'],
+            latency=options['latency'],
+            throttle_rate=options['throttle_rate'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+            branches=tuple(options['branches']),
+            customers_per_branch=customers_per_branch,
+        )
+        server = start_in_thread(config=config)
+        self.crm_state = server.RequestHandlerClass.state
+        host, port = server.server_address
+        crm_base_url = f"http://{host}:{port}"
+
+        old_db_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with (
+                override_settings(REDIS_URL=options['redis_url']),
+                # Фоновые обновления кэшей выполняются сразу в процессе замера, а не рабочими воркерами
+                patched(app.conf, 'task_always_eager', True),
+                patched(crm_service, 'CRM_BASE_URL', crm_base_url),
+                patched(crm_service_async, 'CRM_BASE_URL', crm_base_url),
+                patched(crm_response_cache, 'enabled', not options['no_response_cache']),
+                patched(crm_rate_limiter, 'rate', options['rate_limit'] or crm_rate_limiter.rate),
+                # Внешние сервисы (Express Pay, Telegram) в замерах не участвуют
+                patched(util_erip, 'clear_user_not_paid_invoices', lambda crm_id: None),
+                patched(util_erip, 'get_pay_url', lambda crm_id, amount, name: util_erip.DEFAULT_PAY_URL),
+                patched(check_client_trial_lessons_and_notify, 'send_telegram_message', lambda chat_id, text: None),
+            ):
+                reset_redis_pool()
+                try:
+                    self.create_tables()
+                    users = self.seed_database(options)
+                    results = {
+                        name: self.run_scenario(name, users, options['repeat'])
+                        for name in options['scenarios']
+                    }
+                finally:
+                    self.reset_state()
+                    reset_redis_pool()
+        finally:
+            # Состояние процесса, набранное на тестовой CRM, не должно остаться после замеров
+            self.reset_local_state()
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            server.shutdown()
+
+        report = {
+            'label': options['label'],
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'config': {
+                key: options[key]
+                for key in (
+                    'users', 'clients_per_user', 'branches', 'repeat', 'latency', 'page_size',
+                    'throttle_rate', 'error_rate', 'seed', 'rate_limit', 'no_response_cache', 'redis_url',
+                )
+            },
+            'scenarios': results,
+        }
+        output = options['output'] or os.path.join(
+            'fixtures', 'benchmarks', f"{datetime.now():%Y%m%d_%H%M%S}{'_' + options['label'] if options['label'] else ''}.json"
+        )
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+        self.print_report(results, options['compare'])
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {output}'))
+
+    def reset_local_state(self):
+        clear_local_caches()
+        crm_service.clear_local_token()
+        crm_circuit_breaker.reset_local_state()
+
+    def reset_state(self):
+        """
+        Очищает БД Redis замеров и кэши в памяти процесса,
+        чтобы каждый сценарий начинался с холодных кэшей и закрытого размыкателя.
+        """
+        get_redis_client().flushdb()
+        self.reset_local_state()
+
+    def create_tables(self):
+        """
+        Создает в тестовой БД таблицы моделей, для которых нет миграций.
+        """
+        existing = set(connection.introspection.table_names())
+        with connection.schema_editor() as schema_editor:
+            for model in apps.get_models():
+                if model._meta.db_table not in existing and model._meta.managed and not model._meta.proxy:
+                    schema_editor.create_model(model)
+                    existing.add(model._meta.db_table)
+                    existing.update(field.remote_field.through._meta.db_table for field in model._meta.local_many_to_many)
+
+    def seed_database(self, options) -> list:
+        """
+        Пользователи бота и их клиенты, связанные с клиентами тестовой CRM.
+        """
+        branches = {
+            branch_id: Branch.objects.create(id=branch_id, branch_id=str(branch_id), name=f'Филиал {branch_id}')
+            for branch_id in options['branches']
+        }
+        crm_customers = [
+            customer
+            for branch_id in options['branches']
+            for customer in self.crm_state.branches[branch_id]['customer']
+        ]
+
+        users = []
+        for i in range(options['users']):
+            user = AppUser.objects.create(telegram_id=str(1000000 + i), username=f'user{i}', phone_number=f'+37544{i:07d}')
+            for j in range(options['clients_per_user']):
+                customer = crm_customers[(i * options['clients_per_user'] + j) % len(crm_customers)]
+                client = Client.objects.create(
+                    branch=branches[customer['branch_ids'][0]],
+                    crm_id=str(customer['id']),
+                    name=customer['name'],
+                    is_study=bool(customer['is_study']),
+                    balance=customer['balance'],
+                    paid_lesson_count=customer['paid_lesson_count'],
+                )
+                client.users.add(user)
+            users.append(user)
+        return users
+
+    def call_unit(self, name: str, user, factory: APIRequestFactory):
+        if name == 'get_client_payment_data':
+            return views.get_client_payment_data(factory.post('/', {'user_id': user.telegram_id}, format='json'))
+        if name == 'get_user_tg_links':
+            return views.get_user_tg_links(factory.get('/', {'user_id': user.telegram_id}))
+        if name == 'find_client_by_id_view':
+            return views.find_client_by_id_view(factory.post('/', {'user_id': user.telegram_id}, format='json'))
+        if name == 'create_or_update_clients_in_db_view':
+            crm_ids = {int(crm_id) for crm_id in user.clients.values_list('crm_id', flat=True)}
+            crm_items = [
+                customer
+                for branch in self.crm_state.branches.values()
+                for customer in branch['customer']
+                if customer['id'] in crm_ids
+            ]
+            request = factory.post('/', {'user_id': user.id, 'crm_items': crm_items}, format='json')
+            return views.create_or_update_clients_in_db_view(request)
+        if name == 'sync_all_users_with_crm':
+            return crm_sync.sync_all_users_with_crm()
+        if name == 'check_clients_lessons_before':
+            return check_client_trial_lessons_and_notify.check_clients_lessons_before()
+        raise ValueError(name)
+
+    def run_scenario(self, name: str, users: list, repeat: int) -> dict:
+        """
+        Единица работы: для эндпоинтов - один запрос одного пользователя,
+        для задач - один клиент в БД (задача обрабатывает всех клиентов за запуск).
+        """
+        self.stdout.write(f'Сценарий {name}...')
+        self.reset_state()
+        is_task = name in ('sync_all_users_with_crm', 'check_clients_lessons_before')
+        factory = APIRequestFactory()
+        latencies, errors, units, db_queries = [], 0, 0, 0
+        clients_count = Client.objects.count()
+
+        with self.crm_state.lock:
+            self.crm_state.stats.clear()
+        started = perf_counter()
+        for _ in range(repeat):
+            targets = [None] if is_task else users
+            for user in targets:
+                with CaptureQueriesContext(connection) as queries:
+                    call_started = perf_counter()
+                    try:
+                        response = self.call_unit(name, user, factory)
+                        if response is not None and getattr(response, 'status_code', 200) >= 500:
+                            errors += 1
+                    except Exception as e:
+                        errors += 1
+                        self.stderr.write(f'{name}: {e}')
+                    latencies.append(perf_counter() - call_started)
+                db_queries += len(queries)
+                units += clients_count if is_task else 1
+        wall_time = perf_counter() - started
+
+        with self.crm_state.lock:
+            crm_calls = dict(self.crm_state.stats)
+        crm_total = crm_calls.pop('total', 0)
+        return {
+            'runs': len(latencies),
+            'units': units,
+            'errors': errors,
+            'wall_time': round(wall_time, 4),
+            'latency_mean': round(statistics.fmean(latencies), 4) if latencies else 0.0,
+            'latency_p50': round(percentile(latencies, 50), 4),
+            'latency_p95': round(percentile(latencies, 95), 4),
+            'crm_calls': crm_total,
+            'crm_calls_per_unit': round(crm_total / units, 3) if units else 0.0,
+            'crm_calls_by_endpoint': crm_calls,
+            'db_queries': db_queries,
+            'db_queries_per_unit': round(db_queries / units, 3) if units else 0.0,
+        }
+
+    def print_report(self, results: dict, compare_path: str | None):
+        previous = {}
+        if compare_path:
+            with open(compare_path, encoding='utf-8') as f:
+                previous = json.load(f).get('scenarios', {})
+
+        metrics = ('wall_time', 'latency_p50', 'latency_p95', 'crm_calls_per_unit', 'db_queries_per_unit')
+        for name, result in results.items():
+            self.stdout.write(self.style.SUCCESS(f"{name}: прогонов {result['runs']}, ошибок {result['errors']}"))
+            for metric in metrics:
+                line = f'    {metric}: {result[metric]}'
+                old_value = previous.get(name, {}).get(metric)
+                if old_value:
+                    line += f' (было {old_value}, {(result[metric] - old_value) / old_value:+.1%})'
+                self.stdout.write(line)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from app_api.alfa_crm_service.fake_crm_server import FakeCrmConfig, make_server
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный тестовый сервер AlfaCRM (CRM_HOSTNAME=host:port, CRM_SCHEME=http)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--page-size', type=int, default=50, help='Размер страницы */index')
+        parser.add_argument('--latency', default='0', help='Задержка ответа: 0.05, uniform:0.02:0.2, normal:0.1:0.03, lognormal:-2.5:0.5')
+        parser.add_argument('--throttle-rate', type=float, default=0.0, help='Доля ответов 429')
+        parser.add_argument('--retry-after', type=float, default=1, help='Retry-After для ответов 429, секунды')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов 500')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--branches', type=int, nargs='+', default=[1], help='ID филиалов')
+        parser.add_argument('--customers', type=int, default=200, help='Клиентов в каждом филиале')
+        parser.add_argument('--fixtures', help='JSON с данными филиалов: {"1": {"customer": [...], ...}}')
+        parser.add_argument('--cassette', help='JSON-кассета записанных ответов для воспроизведения')
+        parser.add_argument('--record-upstream', help='URL настоящей CRM: ответы проксируются и записываются в кассету')
+
+    def handle(self, *args, **options):
+        if options['record_upstream'] and not options['cassette']:
+            self.stdout.write(self.style.ERROR('Для записи ответов нужно указать --cassette'))
+            return
+
+        config = FakeCrmConfig(
+            page_size=options['page_size'],
+            latency=options['latency'],
+            throttle_rate=options['throttle_rate'],
+            retry_after=options['retry_after'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+            branches=tuple(options['branches']),
+            customers_per_branch=options['customers'],
+            fixtures=options['fixtures'],
+            cassette=options['cassette'],
+            record_upstream=options['record_upstream'],
+        )
+        server = make_server(options['host'], options['port'], config)
+        self.stdout.write(self.style.SUCCESS(
+            f"Тестовая CRM запущена на http://{options['host']}:{options['port']} "
+            f"(CRM_HOSTNAME={options['host']}:{options['port']}, CRM_SCHEME=http)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Остановка тестовой CRM')
+        finally:
+            server.server_close()
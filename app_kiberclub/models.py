@@ -136,6 +136,9 @@ class AppUser(models.Model):
         db_table = "bot_users"
         verbose_name = "Пользователь"
         verbose_name_plural = "Пользователи"
+        indexes = [
+            models.Index(fields=["phone_number"], name="bot_users_phone_number_idx"),
+        ]
 
 
 class Client(models.Model):
@@ -159,6 +162,9 @@ class Client(models.Model):
 
     is_study = models.BooleanField(default=False, verbose_name="Является клиентом")
     dob = models.DateField(blank=True, null=True, verbose_name="Дата рождения")
+    # Месяц и день рождения отдельно от dob - для поиска именинников по индексу
+    dob_month = models.PositiveSmallIntegerField(blank=True, null=True, editable=False, verbose_name="Месяц рождения")
+    dob_day = models.PositiveSmallIntegerField(blank=True, null=True, editable=False, verbose_name="День рождения")
     balance = models.DecimalField(
         max_digits=10, decimal_places=2, blank=True, null=True, verbose_name="Баланс"
     )
@@ -177,10 +183,35 @@ class Client(models.Model):
     def __str__(self):
         return f"{self.name or 'noname'}"
 
+    def set_dob_parts(self):
+        """
+        Заполняет dob_month и dob_day по dob.
+        bulk_create и bulk_update не вызывают save(), поэтому там метод вызывается явно.
+        """
+        self.dob_month = self.dob.month if self.dob else None
+        self.dob_day = self.dob.day if self.dob else None
+
+    def save(self, *args, **kwargs):
+        self.set_dob_parts()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "dob" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "dob_month", "dob_day"}
+        super().save(*args, **kwargs)
+
     class Meta:
         db_table = "clients"
         verbose_name = "Клиент"
         verbose_name_plural = "Клиенты"
+        constraints = [
+            # Ключ upsert при загрузке клиентов из CRM (bulk_create с update_conflicts)
+            models.UniqueConstraint(fields=["branch", "crm_id"], name="unique_client_branch_crm_id"),
+        ]
+        indexes = [
+            # Веб-приложение и магазин ищут клиента по crm_id без филиала
+            models.Index(fields=["crm_id"], name="clients_crm_id_idx"),
+            models.Index(fields=["paid_lesson_count"], name="clients_paid_lesson_count_idx"),
+            models.Index(fields=["dob_month", "dob_day"], name="clients_dob_month_day_idx"),
+        ]
 
 
 class SalesManager(models.Model):
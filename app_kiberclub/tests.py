@@ -1,3 +1,81 @@
+from datetime import date
+
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
 
-# Create your tests here.
+from app_kiberclub.models import AppUser, Branch, Client
+
+
+class QueryPlanIndexTests(TestCase):
+    """
+    Горячие запросы веб-приложения и задач Celery должны идти по индексам, а не полным сканом таблицы.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+        cls.client_obj = Client.objects.create(branch=cls.branch, crm_id="100", dob=date(2015, 3, 8), paid_lesson_count=0)
+
+    def assertUsesIndex(self, queryset, *plan_patterns: str):
+        """
+        Проверяет, что план запроса содержит хотя бы один из фрагментов plan_patterns
+        (имя индекса или условие поиска по индексу).
+        """
+        if connection.vendor == "postgresql":
+            # На маленькой тестовой таблице PostgreSQL выбрал бы seq scan даже при наличии индекса
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        self.assertTrue(
+            any(pattern in plan for pattern in plan_patterns),
+            f"Индекс {' / '.join(plan_patterns)} не используется:\n{plan}",
+        )
+
+    def test_client_by_crm_id(self):
+        self.assertUsesIndex(Client.objects.filter(crm_id="100"), "clients_crm_id_idx")
+
+    def test_client_by_branch_and_crm_id(self):
+        # SQLite создает индекс ограничения внутри CREATE TABLE под именем sqlite_autoindex_clients_N,
+        # поэтому там проверяется условие поиска по индексу, а в PostgreSQL - имя ограничения
+        self.assertUsesIndex(
+            Client.objects.filter(branch=self.branch, crm_id="100"),
+            "(branch_id=? AND crm_id=?)",
+            "unique_client_branch_crm_id",
+        )
+
+    def test_user_by_phone_number(self):
+        self.assertUsesIndex(AppUser.objects.filter(phone_number="+375291234567"), "bot_users_phone_number_idx")
+
+    def test_clients_with_unpaid_lessons(self):
+        self.assertUsesIndex(Client.objects.filter(paid_lesson_count__lt=1), "clients_paid_lesson_count_idx")
+
+    def test_birthday_clients(self):
+        self.assertUsesIndex(Client.objects.filter(dob_month=3, dob_day=8), "clients_dob_month_day_idx")
+
+
+class ClientModelTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.branch = Branch.objects.create(branch_id="1", name="Филиал 1")
+
+    def test_crm_id_unique_within_branch(self):
+        Client.objects.create(branch=self.branch, crm_id="100")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Client.objects.create(branch=self.branch, crm_id="100")
+
+        other_branch = Branch.objects.create(branch_id="2", name="Филиал 2")
+        Client.objects.create(branch=other_branch, crm_id="100")
+
+    def test_save_sets_dob_parts(self):
+        client = Client.objects.create(branch=self.branch, crm_id="100", dob=date(2015, 3, 8))
+        self.assertEqual((client.dob_month, client.dob_day), (3, 8))
+
+        client.dob = date(2016, 12, 31)
+        client.save(update_fields=["dob"])
+        client.refresh_from_db()
+        self.assertEqual((client.dob_month, client.dob_day), (12, 31))
+
+        client.dob = None
+        client.save()
+        client.refresh_from_db()
+        self.assertEqual((client.dob_month, client.dob_day), (None, None))
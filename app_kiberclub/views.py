@@ -11,7 +11,7 @@ from oauth2client.service_account import ServiceAccountCredentials
 
 from app_api.alfa_crm_service.crm_service import (
     get_client_lessons,
-    get_client_lesson_name,
+    get_subject_name,
     get_client_kiberons,
 )
 from app_kiberclub.models import AppUser, Client, Location
@@ -138,16 +138,8 @@ def open_profile(request):
             subject_id = lesson.get("subject_id")
             logger.debug(f"Последний урок: room_id={room_id}, subject_id={subject_id}")
 
-            lesson_info = get_client_lesson_name(branch_id, subject_id)
-            logger.debug(f"Информация о названии урока: {lesson_info}")
-
-            if lesson_info.get("total") > 0:
-                all_lesson_items = lesson_info.get("items")
-                lesson_name = ""
-                for item in all_lesson_items:
-                    if item.get("id") == subject_id:
-                        lesson_name = item.get("name", "")
-                        logger.debug(f"Название урока найдено: {lesson_name}")
+            lesson_name = get_subject_name(branch_id, subject_id)
+            logger.debug(f"Название урока: {lesson_name}")
 
             if room_id:
                 logger.debug(f"Установлен room_id в сессию: {room_id}")